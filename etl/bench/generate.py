@@ -0,0 +1,195 @@
+import argparse
+import itertools
+import json
+import os
+import random
+
+# share of generated rows per output file, roughly what eventsim produces
+FILE_SHARES = {
+    "page_view_events": 0.52,
+    "listen_events": 0.45,
+    "auth_events": 0.025,
+    "status_change_events": 0.005,
+}
+
+START_TS = 1538352000000  # 2018-10-01, eventsim's default start
+CITIES = [
+    ("New York", "NY", "10001", 40.75, -73.99),
+    ("Los Angeles", "CA", "90001", 33.97, -118.24),
+    ("Chicago", "IL", "60601", 41.88, -87.62),
+    ("Houston", "TX", "77001", 29.81, -95.31),
+    ("Phoenix", "AZ", "85001", 33.45, -112.07),
+    ("Tampa", "FL", "33602", 27.95, -82.46),
+    ("Seattle", "WA", "98101", 47.61, -122.33),
+    ("Denver", "CO", "80202", 39.75, -104.99),
+    ("Boston", "MA", "02108", 42.36, -71.06),
+    ("Atlanta", "GA", "30303", 33.75, -84.39),
+]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/36.0.1985.143 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 "
+    "(KHTML, like Gecko) Version/7.0.5 Safari/537.77.4",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 "
+    "(KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53",
+    "Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; WOW64; Trident/6.0)",
+]
+OTHER_PAGES = ["Home", "Thumbs Up", "Add to Playlist", "Thumbs Down", "Settings"]
+
+
+def make_users(rng, n_users):
+    users = []
+    for user_id in range(1, n_users + 1):
+        city, state, zip_code, lat, lon = rng.choice(CITIES)
+        static = {
+            "city": city,
+            "zip": zip_code,
+            "state": state,
+            "userAgent": rng.choice(USER_AGENTS),
+            "lon": lon,
+            "lat": lat,
+            "lastName": f"Last{user_id}",
+            "firstName": f"First{user_id}",
+            "gender": rng.choice("MF"),
+            "registration": START_TS - rng.randint(0, 90) * 86400000,
+        }
+        users.append(
+            {
+                "userId": user_id,
+                "level": "paid" if rng.random() < 0.2 else "free",
+                # fields that never change, serialised once per user
+                "tail": json.dumps(static, separators=(",", ":"))[1:-1],
+            }
+        )
+    # a few heavy users and a long tail, like real listening activity
+    weights = [1.0 / (rank**0.8) for rank in range(1, n_users + 1)]
+    return users, list(itertools.accumulate(weights))
+
+
+def make_songs(rng, n_songs):
+    songs = []
+    for i in range(n_songs):
+        song = {
+            "artist": f"Artist {rng.randint(1, n_songs // 5 + 1)}",
+            "song": f"Song {i}",
+            "duration": round(rng.uniform(120, 420), 5),
+        }
+        songs.append((json.dumps(song, separators=(",", ":"))[1:-1], song["duration"]))
+    weights = [1.0 / (rank**1.1) for rank in range(1, n_songs + 1)]
+    return songs, list(itertools.accumulate(weights))
+
+
+def event_line(user, session_id, item, ts, page, auth="Logged In", extra=""):
+    method = "PUT" if page == "NextSong" else "GET"
+    return (
+        f'{{"ts":{ts},"userId":{user["userId"]},"sessionId":{session_id},'
+        f'"page":"{page}","auth":"{auth}","method":"{method}","status":200,'
+        f'"level":"{user["level"]}","itemInSession":{item},{extra}{user["tail"]}}}\n'
+    )
+
+
+def generate(out_dir, rows, seed=42, users=None, songs=None):
+    rng = random.Random(seed)
+    n_users = users or max(100, rows // 2000)
+    n_songs = songs or max(1000, rows // 200)
+    user_list, user_weights = make_users(rng, n_users)
+    song_list, song_weights = make_songs(rng, n_songs)
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = {
+        name: open(os.path.join(out_dir, name), "w", buffering=1024 * 1024)
+        for name in FILE_SHARES
+    }
+    counts = dict.fromkeys(FILE_SHARES, 0)
+    targets = {name: int(rows * share) for name, share in FILE_SHARES.items()}
+
+    def write(name, line):
+        files[name].write(line)
+        counts[name] += 1
+
+    # sessions average ~34 page views, spread logins and upgrades over all of them
+    sessions = max(1, targets["page_view_events"] // 34)
+    login_rate = min(1.0, targets["auth_events"] / sessions)
+    status_rate = min(1.0, targets["status_change_events"] / sessions)
+
+    ts = START_TS
+    session_id = 0
+    try:
+        while counts["page_view_events"] < targets["page_view_events"]:
+            user = rng.choices(user_list, cum_weights=user_weights)[0]
+            session_id += 1
+            ts += rng.randint(1000, 60000)
+            t = ts
+            item = 0
+
+            if rng.random() < login_rate:
+                line = event_line(
+                    user, session_id, item, t, "Login", "Logged Out", '"success":true,'
+                )
+                write("auth_events", line)
+                write("page_view_events", line)
+                item += 1
+
+            for _ in range(rng.randint(5, 60)):
+                if rng.random() < 0.85:
+                    song, duration = rng.choices(song_list, cum_weights=song_weights)[0]
+                    line = event_line(
+                        user, session_id, item, t, "NextSong", extra=song + ","
+                    )
+                    write("listen_events", line)
+                    write("page_view_events", line)
+                    t += int(duration * 1000)
+                else:
+                    page = rng.choice(OTHER_PAGES)
+                    write(
+                        "page_view_events", event_line(user, session_id, item, t, page)
+                    )
+                    t += rng.randint(1000, 30000)
+                item += 1
+
+            if rng.random() < status_rate:
+                page = (
+                    "Submit Upgrade" if user["level"] == "free" else "Submit Downgrade"
+                )
+                line = event_line(user, session_id, item, t, page)
+                write("status_change_events", line)
+                write("page_view_events", line)
+                user["level"] = "paid" if user["level"] == "free" else "free"
+    finally:
+        for f in files.values():
+            f.close()
+
+    return counts
+
+
+def parse_scale(value):
+    value = value.lower()
+    for suffix, factor in (("k", 1000), ("m", 1000000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate eventsim-shaped NDJSON for the ETL benchmark"
+    )
+    parser.add_argument("--out", default="bench_data", help="output directory")
+    parser.add_argument(
+        "--rows",
+        type=parse_scale,
+        default=parse_scale("1m"),
+        help="approximate total rows across all files, e.g. 1m, 10m, 50m",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, help="distinct users (default rows/2000)")
+    parser.add_argument("--songs", type=int, help="distinct songs (default rows/200)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    counts = generate(args.out, args.rows, args.seed, args.users, args.songs)
+    for name, count in counts.items():
+        print(f"wrote {count} rows to {os.path.join(args.out, name)}")
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from generate import FILE_SHARES, generate, parse_scale
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from layers import ETL_DIR, load_module  # noqa: E402
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ETL_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(results, stage, func, *args, **kwargs):
+    started = time.perf_counter()
+    rows = func(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    results.append(
+        {
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "rows": rows,
+            "rows_per_sec": round(rows / seconds, 1) if rows and seconds else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+    )
+    print(f"{stage:<40} {seconds:>9.2f}s {rows or 0:>12} rows")
+    return rows
+
+
+def run_benchmark(conn, data_dir, bronze, silver, gold, indexes, args):
+    results = []
+
+    bronze.truncate_bronze(conn)
+    if args.defer_indexes:
+        timed(results, "indexes.defer", indexes.defer_indexes, conn)
+    for name in bronze.EVENT_SPECS:
+        timed(
+            results,
+            f"bronze.{name}",
+            bronze.extract_events,
+            conn,
+            name,
+            path=os.path.join(data_dir, name),
+            loader=args.loader,
+            parser=args.parser,
+        )
+
+    silver.truncate_silver(conn)
+    for name in FILE_SHARES:
+        timed(
+            results,
+            f"silver.{name}",
+            getattr(silver, f"transform_{name}"),
+            conn,
+            full_refresh=True,
+        )
+    if args.defer_indexes:
+        timed(results, "indexes.rebuild", indexes.rebuild_indexes, conn)
+
+    with conn.cursor() as cur:
+        windows = gold.gold_windows(cur)
+    gold.truncate_gold(conn)
+    if args.single_scan:
+        timed(results, "staging.gold_events", gold.stage_gold_events, conn)
+        conn.commit()
+    for table, build in gold.model_builders(args.single_scan).items():
+        with conn.cursor() as cur:
+            lsn = gold.wal_lsn(cur)
+        if args.swap:
+            timed(results, table, gold.rebuild_by_swap, conn, table, build)
+        else:
+            timed(results, table, build, conn)
+        conn.commit()
+        # the write amplification --swap is meant to cut
+        with conn.cursor() as cur:
+            results[-1]["wal_bytes"] = gold.wal_since(cur, lsn)
+        conn.commit()
+    with conn.cursor() as cur:
+        gold.save_gold_watermarks(cur, windows)
+    conn.commit()
+
+    return results
+
+
+def parse_args(bronze):
+    parser = argparse.ArgumentParser(
+        description="Time every ETL stage against a local Postgres"
+    )
+    parser.add_argument("--data-dir", default="bench_data")
+    parser.add_argument(
+        "--database",
+        default="soundflow_bench",
+        help="database to run against; every layer in it is truncated",
+    )
+    parser.add_argument(
+        "--i-know-this-truncates",
+        action="store_true",
+        help="allow a --database whose name does not end in _bench",
+    )
+    parser.add_argument(
+        "--rows",
+        type=parse_scale,
+        default=parse_scale("1m"),
+        help="rows to generate when --data-dir has no data yet, e.g. 1m, 10m, 50m",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--loader", choices=bronze.LOADERS, default="copy-binary")
+    parser.add_argument("--parser", choices=bronze.PARSERS, default="fast")
+    parser.add_argument("--single-scan", action="store_true")
+    parser.add_argument(
+        "--swap",
+        action="store_true",
+        help="build gold in unlogged shadow tables and swap them in",
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="load bronze and silver without secondary indexes and time the rebuild",
+    )
+    parser.add_argument(
+        "--out",
+        help="write results as json here (default bench_<timestamp>.json)",
+    )
+    args = parser.parse_args()
+    if not args.database.endswith("_bench") and not args.i_know_this_truncates:
+        parser.error(
+            f"the benchmark truncates bronze, silver and gold in {args.database}; "
+            "use a *_bench database or pass --i-know-this-truncates"
+        )
+    return args
+
+
+if __name__ == "__main__":
+    bronze = load_module("bronze_extract", "bronze/extract.py")
+    args = parse_args(bronze)
+    # every connection, metrics included, goes to the bench database
+    os.environ["POSTGRES_DB"] = args.database
+    if not all(os.path.exists(os.path.join(args.data_dir, n)) for n in FILE_SHARES):
+        print(f"generating {args.rows} rows in {args.data_dir}")
+        generate(args.data_dir, args.rows, args.seed)
+
+    silver = load_module("silver_transform", "silver/transform.py")
+    gold = load_module("gold_transform", "gold/transform.py")
+    indexes = load_module("indexes", "indexes/indexes.py")
+
+    started_at = datetime.now(timezone.utc)
+    conn = bronze.get_pg_conn()
+    try:
+        stages = run_benchmark(conn, args.data_dir, bronze, silver, gold, indexes, args)
+    finally:
+        conn.close()
+
+    report = {
+        "started_at": started_at.isoformat(),
+        "commit": git_commit(),
+        "data_dir": args.data_dir,
+        "input_rows": {
+            name: sum(1 for _ in open(os.path.join(args.data_dir, name), "rb"))
+            for name in FILE_SHARES
+        },
+        "options": {
+            "loader": args.loader,
+            "parser": args.parser,
+            "single_scan": args.single_scan,
+            "defer_indexes": args.defer_indexes,
+            "swap": args.swap,
+            "database": args.database,
+        },
+        "total_seconds": round(sum(s["seconds"] for s in stages), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": stages,
+    }
+    out = args.out or f"bench_{started_at.strftime('%Y%m%dT%H%M%SZ')}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
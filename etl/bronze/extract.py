@@ -1,292 +1,1023 @@
+import argparse
+import bz2
+import gzip
+import io
 import json
-import psycopg2
+import operator
 import psycopg2.extras
 import os
+import queue
+import signal
+import struct
+import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from layers import load_module  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
 
 BATCH_LIMIT = 1000
+COPY_BATCH_LIMIT = 50000
 
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd", ".bz2": "bz2"}
+READ_BUFFER_BYTES = 1024 * 1024
+# decompressed chunks the reader thread may run ahead of the parser
+DECOMPRESS_QUEUE_CHUNKS = 8
 
-def get_pg_conn():
-    host = os.getenv("POSTGRES_HOST", "localhost")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    dbname = os.getenv("POSTGRES_DB", "soundflow")
-    user = os.getenv("POSTGRES_USER", "postgres")
-    password = os.getenv("POSTGRES_PASSWORD", "postgres")
+# --follow hands a micro-batch to postgres at this many rows or this age
+FOLLOW_BATCH_ROWS = 5000
+FOLLOW_BATCH_SECONDS = 0.5
+FOLLOW_POLL_SECONDS = 0.1
+# batches waiting for postgres before the file readers block
+FOLLOW_QUEUE_BATCHES = 8
 
-    attempt = 0
-    while True:
-        try:
-            return psycopg2.connect(
-                host=host,
-                port=port,
-                dbname=dbname,
-                user=user,
-                password=password,
-                connect_timeout=5,
+LOADERS = ("insert", "copy-text", "copy-binary")
+PARSERS = ("fast", "stdlib")
+
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# microseconds between the unix epoch and the postgres epoch (2000-01-01)
+PG_EPOCH_OFFSET_US = 946684800 * 1000000
+PG_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PG_COPY_TRAILER = struct.pack(">h", -1)
+
+
+def flush_batch(conn, sql, batch, checkpoint=None):
+    if len(batch) == 0 and checkpoint is None:
+        return
+    with conn.cursor() as cur:
+        if batch:
+            psycopg2.extras.execute_batch(
+                cur,
+                sql,
+                batch,
+                page_size=len(batch),
             )
+        if checkpoint is not None:
+            save_checkpoint(cur, checkpoint)
+
+    conn.commit()
+
 
-        except psycopg2.OperationalError as exc:
-            attempt += 1
-            if attempt >= 5:
-                raise RuntimeError(
-                    f"Failed to connect to PostgreSQL after {attempt} attempts"
-                ) from exc
+def copy_text_value(value, pg_type):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if pg_type == "timestamptz":
+        return (UNIX_EPOCH + timedelta(milliseconds=value)).isoformat()
+    if pg_type == "boolean":
+        return "t" if value else "f"
+    if pg_type == "integer":
+        return str(int(value))
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
 
-            sleep_time = 2 * (2 ** (attempt - 1))
-            time.sleep(sleep_time)
 
+def copy_binary_value(value, pg_type):
+    if value is None:
+        return b"\xff\xff\xff\xff"
+    if pg_type == "timestamptz":
+        return struct.pack(">iq", 8, value * 1000 - PG_EPOCH_OFFSET_US)
+    if pg_type == "integer":
+        return struct.pack(">ii", 4, int(value))
+    if pg_type == "boolean":
+        return struct.pack(">i?", 1, bool(value))
 
-def flush_batch(conn, sql, batch):
-    if len(batch) == 0:
+    data = value if isinstance(value, bytes) else str(value).encode("utf-8")
+    if pg_type == "jsonb":
+        # jsonb binary format: version byte followed by the json text
+        return struct.pack(">ib", len(data) + 1, 1) + data
+    return struct.pack(">i", len(data)) + data
+
+
+def encode_copy_text(columns, batch):
+    types = [pg_type for _, pg_type in columns]
+    lines = []
+    for row in batch:
+        lines.append("\t".join(copy_text_value(v, t) for v, t in zip(row, types)))
+    lines.append("")
+    return io.BytesIO("\n".join(lines).encode("utf-8"))
+
+
+def encode_copy_binary(columns, batch):
+    types = [pg_type for _, pg_type in columns]
+    field_count = struct.pack(">h", len(types))
+    buf = io.BytesIO()
+    buf.write(PG_COPY_HEADER)
+    for row in batch:
+        buf.write(field_count)
+        for v, t in zip(row, types):
+            buf.write(copy_binary_value(v, t))
+    buf.write(PG_COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def flush_copy(conn, table, columns, batch, fmt, checkpoint=None):
+    if len(batch) == 0 and checkpoint is None:
         return
+
     with conn.cursor() as cur:
-        psycopg2.extras.execute_batch(
-            cur,
-            sql,
-            batch,
-            page_size=len(batch),
+        if batch:
+            if fmt == "binary":
+                buf = encode_copy_binary(columns, batch)
+            else:
+                buf = encode_copy_text(columns, batch)
+
+            column_list = ", ".join(name for name, _ in columns)
+            cur.copy_expert(
+                f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT {fmt})",
+                buf,
+            )
+        if checkpoint is not None:
+            save_checkpoint(cur, checkpoint)
+
+    conn.commit()
+
+
+def month_of(ts):
+    when = UNIX_EPOCH + timedelta(milliseconds=ts)
+    return when.year, when.month
+
+
+def ensure_partitions(conn, table, batch, known):
+    # event_ts is the first column of every bronze table
+    stamps = [row[0] for row in batch if row[0] is not None]
+    if not stamps:
+        return
+    lo, hi = min(stamps), max(stamps)
+    if {month_of(lo), month_of(hi)} <= known:
+        return
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT ensure_monthly_partitions(
+                %s::regclass, to_timestamp(%s / 1000.0), to_timestamp(%s / 1000.0)
+            )
+            """,
+            (table, lo, hi),
         )
+    conn.commit()
+    known.update((month_of(lo), month_of(hi)))
+
+
+def make_flusher(conn, loader, insert_sql, table, columns):
+    if loader not in LOADERS:
+        raise ValueError(f"Unknown loader {loader!r}, expected one of {LOADERS}")
+    fmt = loader.split("-", 1)[-1]
+    known_months = set()
+
+    def flush(batch, checkpoint=None):
+        started = time.perf_counter()
+        ensure_partitions(conn, table, batch, known_months)
+        if loader == "insert":
+            flush_batch(conn, insert_sql, batch, checkpoint)
+        else:
+            flush_copy(conn, table, columns, batch, fmt, checkpoint)
+        flush.db_seconds += time.perf_counter() - started
+
+    flush.db_seconds = 0.0
+    return flush
+
+
+def reencoded_payload(line, event):
+    return json.dumps(event)
+
+
+def raw_payload(line, event):
+    return line.rstrip(b"\r\n")
+
+
+def raw_payload_text(line, event):
+    return line.rstrip(b"\r\n").decode("utf-8")
+
+
+def make_parser(parser, loader):
+    if parser == "stdlib":
+        return json.loads, reencoded_payload
+
+    # the line already is the payload: pass it through instead of dumping the
+    # parsed dict back to json only for postgres to parse it again
+    loads = orjson.loads if orjson is not None else json.loads
+    if loader == "insert":
+        return loads, raw_payload_text
+    return loads, raw_payload
+
 
+def file_identity(path):
+    st = os.stat(path)
+    return f"{st.st_dev}:{st.st_ino}", st.st_size
+
+
+def resume_position(conn, path):
+    file_id, size = file_identity(path)
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (path,))
+        if not cur.fetchone()[0]:
+            raise RuntimeError(f"{path} is already being ingested by another loader")
+
+        cur.execute(
+            """
+            SELECT file_id, byte_offset, line_number
+            FROM bronze.ingest_checkpoints
+            WHERE file_path = %s
+            """,
+            (path,),
+        )
+        row = cur.fetchone()
     conn.commit()
 
+    # compressed offsets are uncompressed bytes and can exceed the file size
+    truncated = row is not None and row[1] > size and compression_of(path) is None
+    if row is None or row[0] != file_id or truncated:
+        # new, rotated or truncated file: start again from byte zero
+        return file_id, 0, 0
+    return file_id, row[1], row[2]
 
-def extract_auth_events(conn):
-    insert_sql = """
-    INSERT INTO bronze.auth_events 
-    ( event_ts, user_id, session_id, success, level, city, state, payload)
-    VALUES
-    ( to_timestamp(%s / 1000.0), %s, %s, %s, %s, %s, %s, %s::jsonb)
-    """
-    batch = []
-    insert_cnt = 0
 
-    with open("data/auth_events", "r") as f:
-        for ln, line in enumerate(f, start=1):
-            if not line.strip():
-                continue
+def release_file(conn, path):
+    # the lock taken by resume_position is held by the session, a pooled
+    # connection would keep it after the load without this
+    if conn.closed:
+        return
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (path,))
+    conn.commit()
 
-            try:
-                event = json.loads(line)
-
-                batch.append(
-                    (
-                        event.get("ts"),
-                        event.get("userId"),
-                        event.get("sessionId"),
-                        event.get("success"),
-                        event.get("level"),
-                        event.get("city"),
-                        event.get("state"),
-                        json.dumps(event),
-                    )
-                )
 
-                if len(batch) >= BATCH_LIMIT:
-                    flush_batch(conn, insert_sql, batch)
-                    insert_cnt += BATCH_LIMIT
-                    print(f"inserted {insert_cnt} in bronze.auth_events")
-                    batch.clear()
+def checkpoint_for(incremental, path, file_id, pos, ln, last_ts):
+    if not incremental:
+        return None
+    return (path, file_id, pos, ln, last_ts)
 
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON at line {ln}: {e}")
 
-            except Exception as e:
-                conn.rollback()
-                raise RuntimeError(
-                    f"Failed processing file data/auth_events at line {ln}"
-                ) from e
-
-    # Flush remaining records
-    flush_batch(conn, insert_sql, batch)
-    insert_cnt += len(batch)
-    print(f"inserted {insert_cnt} in bronze.auth_events")
-
-
-def extract_page_view_events(conn):
-    insert_sql = """
-    INSERT INTO bronze.page_view_events
-    (event_ts, user_id, session_id,page,method,status, auth,level,artist,song, city, state, payload)
-    VALUES
-    ( to_timestamp(%s / 1000.0), %s, %s, %s, %s, %s, %s,%s,%s,%s,%s,%s, %s::jsonb)
-    """
-    batch = []
-    insert_cnt = 0
+def save_checkpoint(cur, checkpoint):
+    cur.execute(
+        """
+        INSERT INTO bronze.ingest_checkpoints
+        (file_path, file_id, byte_offset, line_number, last_event_ts, updated_at)
+        VALUES
+        (%s, %s, %s, %s, to_timestamp(%s / 1000.0), now())
+        ON CONFLICT (file_path) DO UPDATE SET
+            file_id = EXCLUDED.file_id,
+            byte_offset = EXCLUDED.byte_offset,
+            line_number = EXCLUDED.line_number,
+            last_event_ts = COALESCE(
+                EXCLUDED.last_event_ts, bronze.ingest_checkpoints.last_event_ts
+            ),
+            updated_at = EXCLUDED.updated_at
+        """,
+        checkpoint,
+    )
 
-    with open("data/page_view_events", "r") as f:
-        for ln, line in enumerate(f, start=1):
-            if not line.strip():
-                continue
 
-            try:
-                event = json.loads(line)
-
-                batch.append(
-                    (
-                        event.get("ts"),
-                        event.get("userId"),
-                        event.get("sessionId"),
-                        event.get("page"),
-                        event.get("method"),
-                        event.get("status"),
-                        event.get("auth"),
-                        event.get("level"),
-                        event.get("artist"),
-                        event.get("song"),
-                        event.get("city"),
-                        event.get("state"),
-                        json.dumps(event),
-                    )
-                )
+def batch_limit_for(loader):
+    return BATCH_LIMIT if loader == "insert" else COPY_BATCH_LIMIT
 
-                if len(batch) >= BATCH_LIMIT:
-                    flush_batch(conn, insert_sql, batch)
-                    insert_cnt += BATCH_LIMIT
-                    print(f"inserted {insert_cnt} in bronze.page_view_events")
-                    batch.clear()
 
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON at line {ln}: {e}")
+def report_throughput(
+    table, insert_cnt, started, loader, db_seconds, read_bytes=0, raw_bytes=0
+):
+    elapsed = time.perf_counter() - started
+    rate = insert_cnt / elapsed if elapsed > 0 else 0.0
+    print(
+        f"loaded {insert_cnt} rows into {table} in {elapsed:.2f}s "
+        f"({rate:.0f} rows/s, loader={loader}, "
+        f"read+parse {elapsed - db_seconds:.2f}s, db {db_seconds:.2f}s)"
+    )
+    if elapsed > 0 and read_bytes:
+        print(
+            f"read {read_bytes / elapsed / 1e6:.1f} MB/s from disk, "
+            f"{raw_bytes / elapsed / 1e6:.1f} MB/s uncompressed"
+        )
 
-            except Exception as e:
-                conn.rollback()
-                raise RuntimeError(
-                    f"Failed processing file data/page_view_events at line {ln}"
-                ) from e
-
-    # Flush remaining records
-    flush_batch(conn, insert_sql, batch)
-    insert_cnt += len(batch)
-    print(f"inserted {insert_cnt} in bronze.page_view_events")
-
-
-def extract_status_change_events(conn):
-    insert_sql = """
-    INSERT INTO bronze.status_change_events
-    (event_ts, user_id, session_id, auth,level, city, state, payload)
-    VALUES
-    ( to_timestamp(%s / 1000.0), %s, %s, %s, %s, %s, %s, %s::jsonb)
-    """
-    batch = []
-    insert_cnt = 0
 
-    with open("data/status_change_events", "r") as f:
-        for ln, line in enumerate(f, start=1):
-            if not line.strip():
-                continue
+def compression_of(path):
+    return COMPRESSIONS.get(os.path.splitext(path)[1])
+
+
+def input_candidates(name):
+    base = f"data/{name}"
+    return [base] + [base + suffix for suffix in COMPRESSIONS]
+
+
+def input_path(name):
+    candidates = input_candidates(name)
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return candidates[0]
+
+
+def open_decompressor(path, raw):
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(raw, mode="rb")
+    if zstandard is None:
+        raise RuntimeError(f"reading {path} needs zstandard (uv sync --extra zstd)")
+    return zstandard.ZstdDecompressor().stream_reader(
+        raw, read_size=READ_BUFFER_BYTES, read_across_frames=True
+    )
+
+
+class DecompressedStream(io.RawIOBase):
+    # zlib, bz2 and zstd release the GIL, so with threaded=True decompression
+    # overlaps with json parsing and the database writes
+    def __init__(self, path, threaded=False, partial_ok=False):
+        self.raw = open(path, "rb", buffering=READ_BUFFER_BYTES)
+        self.stream = open_decompressor(path, self.raw)
+        self.partial_ok = partial_ok
+        self.pending = memoryview(b"")
+        self.resumed_at = 0
+        self.chunks = None
+        self.prefetcher = None
+        self.done = threading.Event()
+        if threaded:
+            self.chunks = queue.Queue(maxsize=DECOMPRESS_QUEUE_CHUNKS)
+            self.prefetcher = threading.Thread(target=self.prefetch, daemon=True)
+            self.prefetcher.start()
+
+    def readable(self):
+        return True
+
+    def read_chunk(self):
+        try:
+            return self.stream.read(READ_BUFFER_BYTES)
+        except EOFError:
+            # a compressed file still being written ends mid-stream
+            if self.partial_ok:
+                return b""
+            raise
 
+    def prefetch(self):
+        try:
+            while not self.done.is_set() and (chunk := self.read_chunk()):
+                self.hand_over(chunk)
+            self.hand_over(b"")
+        except Exception as e:
+            self.hand_over(e)
+
+    def hand_over(self, chunk):
+        # gives up once the reader has closed the stream, which may stop
+        # reading (at a partial line) long before the queue drains
+        while not self.done.is_set():
             try:
-                event = json.loads(line)
-
-                batch.append(
-                    (
-                        event.get("ts"),
-                        event.get("userId"),
-                        event.get("sessionId"),
-                        event.get("auth"),
-                        event.get("level"),
-                        event.get("city"),
-                        event.get("state"),
-                        json.dumps(event),
-                    )
-                )
+                self.chunks.put(chunk, timeout=FOLLOW_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
 
-                if len(batch) >= BATCH_LIMIT:
-                    flush_batch(conn, insert_sql, batch)
-                    insert_cnt += BATCH_LIMIT
-                    print(f"inserted {insert_cnt} in bronze.status_change_events")
-                    batch.clear()
+    def next_chunk(self):
+        if self.chunks is None:
+            return self.read_chunk()
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            # keep returning eof on later reads
+            self.chunks.put(b"")
+        return chunk
 
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON at line {ln}: {e}")
+    def readinto(self, b):
+        if not self.pending:
+            self.pending = memoryview(self.next_chunk())
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
 
-            except Exception as e:
-                conn.rollback()
-                raise RuntimeError(
-                    f"Failed processing file data/status_change_events at line {ln}"
-                ) from e
-    # Flush remaining records
-    flush_batch(conn, insert_sql, batch)
-    insert_cnt += len(batch)
-    print(f"inserted {insert_cnt} in bronze.status_change_events")
-
-
-def extract_listen_events(conn):
-    insert_sql = """
-    INSERT INTO bronze.listen_events 
-    ( event_ts, user_id, session_id,artist,song, level,auth, city, state, payload)
-    VALUES
-    ( to_timestamp(%s / 1000.0), %s, %s, %s, %s, %s, %s,%s,%s, %s::jsonb)
-    """
+    def mark_resumed(self):
+        self.resumed_at = self.raw.tell()
+
+    def compressed_bytes(self):
+        # only what was read past the resume position, not the skipped part
+        return self.raw.tell() - self.resumed_at
+
+    def close(self):
+        if not self.closed:
+            if self.prefetcher is not None:
+                # the decompressor must not be closed under the prefetch thread
+                self.done.set()
+                while self.prefetcher.is_alive():
+                    try:
+                        while True:
+                            self.chunks.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self.prefetcher.join(timeout=FOLLOW_POLL_SECONDS)
+            self.stream.close()
+            self.raw.close()
+        super().close()
+
+
+def open_input(path, offset=0, threaded=False, partial_ok=False):
+    if compression_of(path) is None:
+        f = open(path, "rb", buffering=READ_BUFFER_BYTES)
+        f.seek(offset)
+        return f
+
+    f = io.BufferedReader(
+        DecompressedStream(path, threaded, partial_ok), buffer_size=READ_BUFFER_BYTES
+    )
+    # offsets are in uncompressed bytes, so resuming decompresses up to them
+    if offset > 0:
+        while offset > 0:
+            skipped = len(f.read(min(offset, READ_BUFFER_BYTES)))
+            if skipped == 0:
+                break
+            offset -= skipped
+        f.raw.mark_resumed()
+    return f
+
+
+def compressed_bytes(f, uncompressed):
+    if isinstance(f.raw, DecompressedStream):
+        return f.raw.compressed_bytes()
+    return uncompressed
+
+
+def describe_line(path, ln, start):
+    if start == 0:
+        return f"line {ln} of {path}"
+    return f"line {ln} of {path} (chunk starting at byte {start})"
+
+
+# one entry per eventsim output file: target table and
+# (column, json field, postgres type); a field of None is the raw payload
+EVENT_SPECS = {
+    "auth_events": {
+        "table": "bronze.auth_events",
+        "columns": (
+            ("event_ts", "ts", "timestamptz"),
+            ("user_id", "userId", "integer"),
+            ("session_id", "sessionId", "integer"),
+            ("success", "success", "boolean"),
+            ("level", "level", "text"),
+            ("city", "city", "text"),
+            ("state", "state", "text"),
+            ("payload", None, "jsonb"),
+        ),
+    },
+    "listen_events": {
+        "table": "bronze.listen_events",
+        "columns": (
+            ("event_ts", "ts", "timestamptz"),
+            ("user_id", "userId", "integer"),
+            ("session_id", "sessionId", "integer"),
+            ("artist", "artist", "text"),
+            ("song", "song", "text"),
+            ("level", "level", "text"),
+            ("auth", "auth", "text"),
+            ("city", "city", "text"),
+            ("state", "state", "text"),
+            ("payload", None, "jsonb"),
+        ),
+    },
+    "status_change_events": {
+        "table": "bronze.status_change_events",
+        "columns": (
+            ("event_ts", "ts", "timestamptz"),
+            ("user_id", "userId", "integer"),
+            ("session_id", "sessionId", "integer"),
+            ("auth", "auth", "text"),
+            ("level", "level", "text"),
+            ("city", "city", "text"),
+            ("state", "state", "text"),
+            ("payload", None, "jsonb"),
+        ),
+    },
+    "page_view_events": {
+        "table": "bronze.page_view_events",
+        "columns": (
+            ("event_ts", "ts", "timestamptz"),
+            ("user_id", "userId", "integer"),
+            ("session_id", "sessionId", "integer"),
+            ("page", "page", "text"),
+            ("method", "method", "text"),
+            ("status", "status", "integer"),
+            ("auth", "auth", "text"),
+            ("level", "level", "text"),
+            ("artist", "artist", "text"),
+            ("song", "song", "text"),
+            ("city", "city", "text"),
+            ("state", "state", "text"),
+            ("payload", None, "jsonb"),
+        ),
+    },
+}
+
+
+def build_insert_sql(table, columns):
+    placeholders = []
+    for _, _, pg_type in columns:
+        if pg_type == "timestamptz":
+            placeholders.append("to_timestamp(%s / 1000.0)")
+        elif pg_type == "jsonb":
+            placeholders.append("%s::jsonb")
+        else:
+            placeholders.append("%s")
+    return (
+        f"INSERT INTO {table} ({', '.join(name for name, _, _ in columns)}) "
+        f"VALUES ({', '.join(placeholders)})"
+    )
+
+
+def compile_row_builder(columns, payload):
+    # the payload must be the last column, everything before it is a field
+    fields = [field for _, field, _ in columns[:-1]]
+    if columns[-1][1] is not None or None in fields:
+        raise ValueError("the raw payload must be the last column of a spec")
+
+    fast_get = operator.itemgetter(*fields)
+    if len(fields) == 1:
+        single_get = fast_get
+
+        def fast_get(event):
+            return (single_get(event),)
+
+    def build_row(line, event):
+        try:
+            values = fast_get(event)
+        except KeyError:
+            # eventsim omits some fields on some events, e.g. logged out users
+            values = tuple(event.get(field) for field in fields)
+        return values + (payload(line, event),)
+
+    return build_row
+
+
+@instrumented("bronze", name_arg="name")
+def extract_events(
+    conn,
+    name,
+    loader="insert",
+    path=None,
+    start=0,
+    end=None,
+    incremental=False,
+    parser="fast",
+    decompress_thread=False,
+):
+    spec = EVENT_SPECS[name]
+    table = spec["table"]
+    path = path or input_path(name)
+    copy_columns = tuple((column, pg_type) for column, _, pg_type in spec["columns"])
+    insert_sql = build_insert_sql(table, spec["columns"])
+
+    flush = make_flusher(conn, loader, insert_sql, table, copy_columns)
+    loads, payload = make_parser(parser, loader)
+    build_row = compile_row_builder(spec["columns"], payload)
+    batch_size = batch_limit_for(loader)
     batch = []
     insert_cnt = 0
+    started = time.perf_counter()
+    file_id, offset, line_offset = None, start, 0
+    if incremental:
+        file_id, offset, line_offset = resume_position(conn, path)
+    last_ln, last_ts = line_offset, None
 
-    with open("data/listen_events", "r") as f:
-        for ln, line in enumerate(f, start=1):
-            if not line.strip():
-                continue
+    try:
+        with open_input(path, offset, decompress_thread, incremental) as f:
+            pos = offset
+            for ln, line in enumerate(f, start=line_offset + 1):
+                if end is not None and pos >= end:
+                    break
+                if incremental and not line.endswith(b"\n"):
+                    # the writer has not finished this line yet
+                    break
+                pos += len(line)
+                last_ln = ln
+                if not line.strip():
+                    continue
 
-            try:
-                event = json.loads(line)
-
-                batch.append(
-                    (
-                        event.get("ts"),
-                        event.get("userId"),
-                        event.get("sessionId"),
-                        event.get("artist"),
-                        event.get("song"),
-                        event.get("level"),
-                        event.get("auth"),
-                        event.get("city"),
-                        event.get("state"),
-                        json.dumps(event),
-                    )
-                )
+                try:
+                    row = build_row(line, loads(line))
+                    batch.append(row)
+                    if row[0] is not None:
+                        last_ts = row[0]
 
-                if len(batch) >= BATCH_LIMIT:
-                    flush_batch(conn, insert_sql, batch)
-                    insert_cnt += BATCH_LIMIT
-                    print(f"inserted {insert_cnt} in bronze.listen_events")
-                    batch.clear()
+                    if len(batch) >= batch_size:
+                        flush(
+                            batch,
+                            checkpoint_for(
+                                incremental, path, file_id, pos, ln, last_ts
+                            ),
+                        )
+                        insert_cnt += len(batch)
+                        print(f"inserted {insert_cnt} in {table}")
+                        batch.clear()
 
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON at line {ln}: {e}")
+                except json.JSONDecodeError as e:
+                    print(f"Invalid JSON at {describe_line(path, ln, start)}: {e}")
 
-            except Exception as e:
-                conn.rollback()
-                raise RuntimeError(
-                    f"Failed processing file data/listen_events at line {ln}"
-                ) from e
-
-    # Flush remaining records
-    flush_batch(conn, insert_sql, batch)
-    insert_cnt += len(batch)
-    print(f"inserted {insert_cnt} in bronze.listen_events")
-
-
-def truncate_bronze(conn):
-    sql = """
-    TRUNCATE TABLE
-        bronze.auth_events,
-        bronze.listen_events,
-        bronze.status_change_events,
-        bronze.page_view_events
-    RESTART IDENTITY;
-    """
+                except Exception as e:
+                    conn.rollback()
+                    raise RuntimeError(
+                        f"Failed processing {describe_line(path, ln, start)}"
+                    ) from e
+            read_bytes = compressed_bytes(f, pos - offset)
+
+        # Flush remaining records
+        flush(batch, checkpoint_for(incremental, path, file_id, pos, last_ln, last_ts))
+        insert_cnt += len(batch)
+        print(f"inserted {insert_cnt} in {table}")
+        report_throughput(
+            table,
+            insert_cnt,
+            started,
+            loader,
+            flush.db_seconds,
+            read_bytes,
+            pos - offset,
+        )
+    finally:
+        if incremental:
+            release_file(conn, path)
+    return insert_cnt
+
+
+def extract_auth_events(conn, **options):
+    return extract_events(conn, "auth_events", **options)
+
+
+def extract_listen_events(conn, **options):
+    return extract_events(conn, "listen_events", **options)
+
+
+def extract_status_change_events(conn, **options):
+    return extract_events(conn, "status_change_events", **options)
+
+
+def extract_page_view_events(conn, **options):
+    return extract_events(conn, "page_view_events", **options)
+
+
+def truncate_bronze(conn, names=tuple(EVENT_SPECS)):
+    tables = ", ".join(EVENT_SPECS[name]["table"] for name in names)
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(f"TRUNCATE TABLE {tables} RESTART IDENTITY")
+        cur.execute(
+            "DELETE FROM bronze.ingest_checkpoints WHERE file_path = ANY(%s)",
+            ([path for name in names for path in input_candidates(name)],),
+        )
     conn.commit()
 
 
+def split_file(path, chunk_bytes):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        pos = chunk_bytes
+        while pos < size:
+            # move the boundary forward to the start of the next line
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            bounds.append(pos)
+            pos += chunk_bytes
+
+    return [
+        (start, end if end < size else None)
+        for start, end in zip(bounds, bounds[1:] + [size])
+    ]
+
+
+def load_chunk(task):
+    name, path, options = task
+    conn = get_pg_conn()
+    try:
+        return name, extract_events(conn, name, path=path, **options)
+    finally:
+        conn.close()
+
+
+def extract_parallel(names, workers, chunk_bytes, **options):
+    tasks = []
+    for name in names:
+        path = input_path(name)
+        if options.get("incremental") or compression_of(path) is not None:
+            # checkpoints are per file and compressed streams cannot be
+            # entered mid-way, so those files stay on one worker
+            tasks.append((name, path, options))
+            continue
+        for start, end in split_file(path, chunk_bytes):
+            tasks.append((name, path, dict(options, start=start, end=end)))
+
+    totals = dict.fromkeys(names, 0)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for name, insert_cnt in pool.map(load_chunk, tasks):
+            totals[name] += insert_cnt
+
+    for name, insert_cnt in totals.items():
+        print(f"inserted {insert_cnt} in bronze.{name} ({workers} workers)")
+
+
+def file_rotated(f, path, pos):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        # mid-rotation: keep reading the old file until the new one appears
+        return False
+    opened = os.fstat(f.fileno())
+    if (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino):
+        return True
+    return st.st_size < pos
+
+
+def follow_file(name, path, position, loader, parser, batches, stop):
+    file_id, pos, ln = position
+    loads, payload = make_parser(parser, loader)
+    build_row = compile_row_builder(EVENT_SPECS[name]["columns"], payload)
+    batch, last_ts, deadline = [], None, None
+    rotated = False
+    f = open(path, "rb")
+    f.seek(pos)
+    try:
+        while not stop.is_set():
+            line = f.readline()
+            if line.endswith(b"\n"):
+                pos += len(line)
+                ln += 1
+                if line.strip():
+                    try:
+                        row = build_row(line, loads(line))
+                    except json.JSONDecodeError as e:
+                        print(f"Invalid JSON at {describe_line(path, ln, 0)}: {e}")
+                        continue
+                    batch.append(row)
+                    if row[0] is not None:
+                        last_ts = row[0]
+                    if deadline is None:
+                        deadline = time.monotonic() + FOLLOW_BATCH_SECONDS
+                if len(batch) < FOLLOW_BATCH_ROWS and (
+                    not batch or time.monotonic() < deadline
+                ):
+                    continue
+            else:
+                # leave a half-written line for the next poll
+                f.seek(pos)
+                if not rotated and file_rotated(f, path, pos):
+                    # like tail -F, read the old file to its end first: lines
+                    # may have landed between the last read and the stat
+                    rotated = True
+                    continue
+                if rotated:
+                    if batch:
+                        put_batch(
+                            batches, name, batch, (path, file_id, pos, ln, last_ts)
+                        )
+                        batch, deadline = [], None
+                    f.close()
+                    f = open(path, "rb")
+                    file_id, _ = file_identity(path)
+                    pos, ln = 0, 0
+                    rotated = False
+                    print(f"{path} was rotated, following the new file")
+                    continue
+                if not batch or time.monotonic() < deadline:
+                    stop.wait(FOLLOW_POLL_SECONDS)
+                    continue
+
+            put_batch(batches, name, batch, (path, file_id, pos, ln, last_ts))
+            batch, deadline = [], None
+
+        if batch:
+            put_batch(batches, name, batch, (path, file_id, pos, ln, last_ts))
+    except Exception as e:
+        batches.put((name, e, None))
+    finally:
+        f.close()
+
+
+def put_batch(batches, name, batch, checkpoint):
+    if batches.full():
+        print(f"bronze is behind, pausing reads of {checkpoint[0]}")
+    # blocks while the queue is full, so readers never run ahead of postgres
+    batches.put((name, batch, checkpoint))
+
+
+def refresh_downstream(refresh_seconds, stop):
+    silver = load_module("silver_transform", "silver/transform.py")
+    gold = load_module("gold_transform", "gold/transform.py")
+    conn = get_pg_conn()
+    try:
+        while not stop.wait(refresh_seconds):
+            started = time.perf_counter()
+            try:
+                silver.run_transforms(conn, full_refresh=False)
+                gold.run_gold_incremental(conn)
+            except Exception as e:
+                print(f"silver/gold refresh failed, retrying next cycle: {e!r}")
+                if conn.closed:
+                    conn = get_pg_conn()
+                else:
+                    conn.rollback()
+                continue
+            print(f"refreshed silver and gold in {time.perf_counter() - started:.2f}s")
+    finally:
+        conn.close()
+
+
+def follow_events(conn, names, loader="insert", parser="fast", refresh_seconds=5.0):
+    stop = threading.Event()
+    handlers = {}
+    # signal handlers can only be installed from the main thread, the
+    # pipeline runs this stage on a worker
+    if threading.current_thread() is threading.main_thread():
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            handlers[sig] = signal.signal(sig, lambda *_: stop.set())
+
+    batches = queue.Queue(maxsize=FOLLOW_QUEUE_BATCHES)
+    flushers = {}
+    readers = []
+    threads = []
+    locked = []
+    totals = dict.fromkeys(names, 0)
+    try:
+        for name in names:
+            spec = EVENT_SPECS[name]
+            path = f"data/{name}"
+            while not os.path.exists(path) and not stop.is_set():
+                print(f"waiting for {path}")
+                stop.wait(1.0)
+            if stop.is_set():
+                return
+
+            copy_columns = tuple((column, t) for column, _, t in spec["columns"])
+            flushers[name] = make_flusher(
+                conn,
+                loader,
+                build_insert_sql(spec["table"], spec["columns"]),
+                spec["table"],
+                copy_columns,
+            )
+            position = resume_position(conn, path)
+            locked.append(path)
+            readers.append(
+                threading.Thread(
+                    target=follow_file,
+                    args=(name, path, position, loader, parser, batches, stop),
+                    name=f"follow-{name}",
+                    daemon=True,
+                )
+            )
+
+        threads = list(readers)
+        if refresh_seconds > 0:
+            threads.append(
+                threading.Thread(
+                    target=refresh_downstream,
+                    args=(refresh_seconds, stop),
+                    name="refresh",
+                    daemon=True,
+                )
+            )
+        for thread in threads:
+            thread.start()
+
+        # drain until every reader has handed over its last batch
+        while any(reader.is_alive() for reader in readers) or not batches.empty():
+            try:
+                name, batch, checkpoint = batches.get(timeout=FOLLOW_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if isinstance(batch, Exception):
+                raise RuntimeError(f"following data/{name} failed") from batch
+
+            flushers[name](batch, checkpoint)
+            totals[name] += len(batch)
+            lag = time.time() - checkpoint[4] / 1000 if checkpoint[4] else 0.0
+            print(
+                f"inserted {len(batch)} in {EVENT_SPECS[name]['table']} "
+                f"({totals[name]} total, event lag {lag:.1f}s)"
+            )
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=30)
+        for path in locked:
+            release_file(conn, path)
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+    return sum(totals.values())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load eventsim output into bronze")
+    parser.add_argument(
+        "--loader",
+        choices=LOADERS,
+        default="insert",
+        help="execute_batch INSERTs or COPY FROM STDIN in text/binary format",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="load files in parallel with this many processes (0 = serial)",
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        type=int,
+        default=256,
+        help="split files larger than this into line-aligned chunks per worker",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="keep bronze and resume each file from its last checkpoint",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep tailing the files like tail -F and load new lines as they arrive",
+    )
+    parser.add_argument(
+        "--refresh-seconds",
+        type=float,
+        default=5.0,
+        help="with --follow, refresh silver and gold incrementally this often "
+        "(0 = bronze only)",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=PARSERS,
+        default="fast",
+        help="fast: orjson when installed and the raw line as payload; "
+        "stdlib: json.loads + json.dumps",
+    )
+    parser.add_argument(
+        "--decompress-thread",
+        action="store_true",
+        help="decompress .gz/.zst/.bz2 inputs on a separate thread",
+    )
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        choices=list(EVENT_SPECS),
+        default=list(EVENT_SPECS),
+        help="only load these event files",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     conn = get_pg_conn()
     try:
-        truncate_bronze(conn)
-        extract_auth_events(conn)
-        extract_listen_events(conn)
-        extract_status_change_events(conn)
-        extract_page_view_events(conn)
+        with etl_run(get_pg_conn, "bronze", args.metrics_jsonl, vars(args)):
+            if args.follow:
+                follow_events(
+                    conn, args.tables, args.loader, args.parser, args.refresh_seconds
+                )
+                return
+
+            if not args.incremental:
+                truncate_bronze(conn, args.tables)
+            options = {
+                "loader": args.loader,
+                "incremental": args.incremental,
+                "parser": args.parser,
+                "decompress_thread": args.decompress_thread,
+            }
+            if args.workers > 0:
+                extract_parallel(
+                    args.tables, args.workers, args.chunk_mb * 1024 * 1024, **options
+                )
+                return
+
+            for name in args.tables:
+                extract_events(conn, name, **options)
     finally:
         conn.close()
 
@@ -0,0 +1,42 @@
+import psycopg2
+import psycopg2.pool
+import os
+import time
+
+
+def connection_params():
+    return {
+        "host": os.getenv("POSTGRES_HOST", "localhost"),
+        "port": os.getenv("POSTGRES_PORT", "5432"),
+        "dbname": os.getenv("POSTGRES_DB", "soundflow"),
+        "user": os.getenv("POSTGRES_USER", "postgres"),
+        "password": os.getenv("POSTGRES_PASSWORD", "postgres"),
+        "connect_timeout": 5,
+    }
+
+
+def with_retry(connect):
+    attempt = 0
+    while True:
+        try:
+            return connect()
+
+        except psycopg2.OperationalError as exc:
+            attempt += 1
+            if attempt >= 5:
+                raise RuntimeError(
+                    f"Failed to connect to PostgreSQL after {attempt} attempts"
+                ) from exc
+
+            sleep_time = 2 * (2 ** (attempt - 1))
+            time.sleep(sleep_time)
+
+
+def get_pg_conn():
+    return with_retry(lambda: psycopg2.connect(**connection_params()))
+
+
+def get_pg_pool(maxconn):
+    return with_retry(
+        lambda: psycopg2.pool.ThreadedConnectionPool(1, maxconn, **connection_params())
+    )
@@ -0,0 +1,156 @@
+import argparse
+import csv
+import io
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# stage modules sit next to this file, also when the pipeline loads it by path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+import geo  # noqa: E402
+
+BATCH_ROWS = 10000
+
+SILVER_SOURCES = {
+    "silver.auth_events": "bronze.auth_events",
+    "silver.listen_events": "bronze.listen_events",
+    "silver.page_view_events": "bronze.page_view_events",
+    "silver.status_change_events": "bronze.status_change_events",
+}
+
+# name -> the rows it reads from each silver table (a query over {source}
+# limited to %(low)s < ingestion_ts <= %(high)s), the table it fills and a
+# factory for its batch function, which maps a dict of column lists to rows
+ENRICHMENTS = {
+    "geo": {
+        "select": geo.SELECT_SQL,
+        "target": "silver.geo_zcta",
+        "columns": geo.COLUMNS,
+        "make": geo.make_enricher,
+    },
+}
+
+
+def enrichment_window(cur, stage, source):
+    cur.execute(
+        """
+        SELECT high_water_ts FROM silver.enrichment_watermarks
+        WHERE stage = %s AND source_table = %s
+        """,
+        (stage, source),
+    )
+    row = cur.fetchone()
+    low = row[0] if row else "-infinity"
+
+    # silver advances its watermark in the transaction that inserts the rows
+    cur.execute(
+        "SELECT high_water_ts FROM silver.watermarks WHERE source_table = %s",
+        (SILVER_SOURCES[source],),
+    )
+    row = cur.fetchone()
+    return low, row[0] if row else None
+
+
+def save_enrichment_watermark(cur, stage, source, high):
+    cur.execute(
+        """
+        INSERT INTO silver.enrichment_watermarks (stage, source_table, high_water_ts)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (stage, source_table) DO UPDATE SET
+            high_water_ts = EXCLUDED.high_water_ts,
+            updated_at = now()
+        """,
+        (stage, source, high),
+    )
+
+
+def copy_rows(cur, table, columns, rows):
+    buf = io.StringIO()
+    # everything but None is quoted, so only NULLs become unquoted empty fields
+    csv.writer(buf, quoting=csv.QUOTE_NOTNULL).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+
+def enrich_source(conn, name, stage, enrich, source, batch_rows):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"enrich:{name}",))
+        low, high = enrichment_window(cur, name, source)
+    if high is None:
+        conn.commit()
+        return 0
+
+    written = 0
+    # the named cursor keeps the result set on the server, so only one
+    # batch of input and output rows is in memory at a time
+    with conn.cursor(name=f"enrich_{name}") as reader, conn.cursor() as writer:
+        reader.itersize = batch_rows
+        reader.execute(
+            stage["select"].format(source=source, target=stage["target"]),
+            {"low": low, "high": high},
+        )
+        while rows := reader.fetchmany(batch_rows):
+            names = [column.name for column in reader.description]
+            out = enrich(dict(zip(names, map(list, zip(*rows)))))
+            copy_rows(writer, stage["target"], stage["columns"], out)
+            written += len(out)
+        save_enrichment_watermark(writer, name, source, high)
+
+    conn.commit()
+    print(f"enriched {written} rows from {source} into {stage['target']}")
+    return written
+
+
+@instrumented("enrich", name_arg="name")
+def run_enrichment(conn, name, options=None, batch_rows=BATCH_ROWS):
+    stage = ENRICHMENTS[name]
+    enrich = stage["make"](options or {})
+    return sum(
+        enrich_source(conn, name, stage, enrich, source, batch_rows)
+        for source in SILVER_SOURCES
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Stream silver through python enrichments"
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(ENRICHMENTS),
+        default=list(ENRICHMENTS),
+    )
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=BATCH_ROWS,
+        help="rows fetched from the server-side cursor per batch",
+    )
+    parser.add_argument(
+        "--gazetteer",
+        default=geo.GAZETTEER_PATH,
+        help="census ZCTA gazetteer used by the geo stage",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        with etl_run(get_pg_conn, "enrich", args.metrics_jsonl, vars(args)):
+            for name in args.stages:
+                run_enrichment(conn, name, vars(args), args.batch_rows)
+    finally:
+        conn.close()
@@ -0,0 +1,103 @@
+import csv
+import math
+import os
+
+GAZETTEER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "events",
+    "data",
+    "Gaz_zcta_national.txt",
+)
+
+# centroids are bucketed into CELL_DEGREES squares; the search gives up
+# MAX_RINGS cells away, i.e. for coordinates outside the US
+CELL_DEGREES = 0.5
+MAX_RINGS = 20
+KM_PER_DEGREE = 111.2
+EARTH_RADIUS_KM = 6371.0
+
+COLUMNS = ("lat", "lon", "zcta", "distance_km")
+
+SELECT_SQL = """
+SELECT DISTINCT s.lat, s.lon
+FROM {source} s
+WHERE s.ingestion_ts > %(low)s
+  AND s.ingestion_ts <= %(high)s
+  AND s.lat IS NOT NULL
+  AND s.lon IS NOT NULL
+  AND NOT EXISTS (
+      SELECT 1 FROM {target} t WHERE t.lat = s.lat AND t.lon = s.lon
+  )
+"""
+
+
+def cell_of(lat, lon):
+    return math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES)
+
+
+def load_grid(path):
+    grid = {}
+    with open(path, newline="", encoding="latin-1") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = [column.strip() for column in next(reader)]
+        geoid = header.index("GEOID")
+        lat_at = header.index("INTPTLAT")
+        lon_at = header.index("INTPTLONG")
+        for row in reader:
+            lat, lon = float(row[lat_at]), float(row[lon_at].strip())
+            grid.setdefault(cell_of(lat, lon), []).append(
+                (row[geoid], math.radians(lat), math.radians(lon))
+            )
+    return grid
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def ring(row, col, r):
+    if r == 0:
+        yield row, col
+        return
+    for dc in range(-r, r + 1):
+        yield row - r, col + dc
+        yield row + r, col + dc
+    for dr in range(-r + 1, r):
+        yield row + dr, col - r
+        yield row + dr, col + r
+
+
+def nearest(grid, lat, lon):
+    row, col = cell_of(lat, lon)
+    lat_r, lon_r = math.radians(lat), math.radians(lon)
+    best, best_km = None, math.inf
+    for r in range(MAX_RINGS + 1):
+        # every centroid in ring r is at least r - 1 cells away; longitude
+        # cells shrink towards the poles
+        shrink = math.cos(math.radians(min(89.0, abs(lat) + r * CELL_DEGREES)))
+        if best_km <= (r - 1) * CELL_DEGREES * KM_PER_DEGREE * shrink:
+            break
+        for cell in ring(row, col, r):
+            for zcta, c_lat, c_lon in grid.get(cell, ()):
+                km = haversine_km(lat_r, lon_r, c_lat, c_lon)
+                if km < best_km:
+                    best, best_km = zcta, km
+    if best is None:
+        return None, None
+    return best, round(best_km, 3)
+
+
+def make_enricher(options):
+    grid = load_grid(options.get("gazetteer") or GAZETTEER_PATH)
+
+    def enrich(batch):
+        return [
+            (lat, lon, *nearest(grid, lat, lon))
+            for lat, lon in zip(batch["lat"], batch["lon"])
+        ]
+
+    return enrich
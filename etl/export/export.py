@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+FETCH_ROWS = 50000
+STATE_FILE = "_export_state.json"
+TEXT_TYPES = (25, 1043)
+
+SILVER_TABLES = {
+    "silver.auth_events": "bronze.auth_events",
+    "silver.listen_events": "bronze.listen_events",
+    "silver.page_view_events": "bronze.page_view_events",
+    "silver.status_change_events": "bronze.status_change_events",
+}
+
+# gold model -> date column it is partitioned by, None for a single file
+GOLD_MODELS = {
+    "gold.daily_user_activity": "activity_date",
+    "gold.daily_song_plays": "play_date",
+    "gold.user_sessions": None,
+    "gold.subscription_funnel_daily": "event_date",
+    "gold.subscription_transitions": "event_date",
+    "gold.daily_geo_activity": "activity_date",
+    "gold.daily_level_state_users": "activity_date",
+    "gold.user_lifetime_metrics": None,
+    "gold.user_activity_rollup": None,
+    "gold.geo_activity_rollup": None,
+    "gold.song_plays_rollup": None,
+    "gold.level_state_cube": None,
+}
+
+
+def arrow_type(type_code):
+    # pg_type oids of the column types silver and gold use; anything else is
+    # written as its text form
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1007: pa.list_(pa.int32()),
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+    }.get(type_code, pa.string())
+
+
+def arrow_column(values, type_code, arrow_type):
+    if arrow_type == pa.string() and type_code not in TEXT_TYPES:
+        values = [None if value is None else str(value) for value in values]
+    return pa.array(values, type=arrow_type)
+
+
+def load_state(out_dir):
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def table_dir(out_dir, table):
+    return os.path.join(out_dir, *table.split("."))
+
+
+def write_parquet(conn, sql, params, path):
+    # a named cursor keeps the result on the server; only FETCH_ROWS rows and
+    # one row group are ever held in memory
+    tmp_path = f"{path}.tmp"
+    writer = None
+    rows_written = 0
+    with conn.cursor(name="parquet_export") as cur:
+        cur.itersize = FETCH_ROWS
+        cur.execute(sql, params)
+        while rows := cur.fetchmany(FETCH_ROWS):
+            if writer is None:
+                schema = pa.schema(
+                    [
+                        (column.name, arrow_type(column.type_code))
+                        for column in cur.description
+                    ]
+                )
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+            columns = [
+                arrow_column(values, column.type_code, field.type)
+                for values, column, field in zip(zip(*rows), cur.description, schema)
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+            rows_written += len(rows)
+    conn.commit()
+
+    if writer is None:
+        # the partition is empty now, drop any earlier export of it
+        if os.path.exists(path):
+            os.remove(path)
+        return 0
+    writer.close()
+    os.replace(tmp_path, path)
+    return rows_written
+
+
+def changed_dates(cur, windows, day_sql="date(event_ts AT TIME ZONE 'UTC')"):
+    # windows: silver table -> (exported up to, safe to export up to)
+    branches = []
+    params = []
+    for table, (low, high) in windows.items():
+        branches.append(
+            f"SELECT {day_sql} FROM {table} "
+            "WHERE ingestion_ts > %s AND ingestion_ts <= %s"
+        )
+        params.extend([low, high])
+    if not branches:
+        return []
+    cur.execute(" UNION ".join(branches), params)
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def watermark(cur, table, source_table):
+    cur.execute(
+        f"SELECT high_water_ts FROM {table} WHERE source_table = %s",
+        (source_table,),
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def windows_since(cur, exported, watermark_table, sources):
+    windows = {}
+    for table, source in sources.items():
+        high = watermark(cur, watermark_table, source)
+        low = exported.get(table)
+        if high is not None and (low is None or high > datetime.fromisoformat(low)):
+            windows[table] = (low or "-infinity", high)
+    return windows
+
+
+def partition_path(out_dir, table, column, day):
+    return os.path.join(
+        table_dir(out_dir, table), f"{column}={day.isoformat()}", "part-0.parquet"
+    )
+
+
+@instrumented("export", name_arg="table")
+def export_silver_table(conn, out_dir, table, window):
+    with conn.cursor() as cur:
+        days = changed_dates(cur, {table: window})
+    conn.commit()
+
+    rows = 0
+    for day in days:
+        rows += write_parquet(
+            conn,
+            f"""
+            SELECT * FROM {table}
+            WHERE event_ts >= (%(day)s::date)::timestamp AT TIME ZONE 'UTC'
+              AND event_ts < (%(day)s::date + 1)::timestamp AT TIME ZONE 'UTC'
+            """,
+            {"day": day},
+            partition_path(out_dir, table, "event_date", day),
+        )
+    print(f"exported {rows} rows in {len(days)} partitions of {table}")
+    return rows
+
+
+def table_version(cur, table):
+    # changes with every insert, update or delete, so an unchanged model is
+    # not rewritten; scanning it is still cheaper than exporting it
+    cur.execute(f"SELECT count(*), max(xmin::text::bigint) FROM {table}")
+    return "{}:{}".format(*cur.fetchone())
+
+
+def prune_partitions(conn, out_dir, table, column):
+    # a day whose rows were all deleted never shows up in the changed dates,
+    # its partition is dropped once the model has no row for it
+    root = table_dir(out_dir, table)
+    if not os.path.isdir(root):
+        return 0
+    prefix = f"{column}="
+    days = [name[len(prefix) :] for name in os.listdir(root) if name.startswith(prefix)]
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT d::text
+            FROM unnest(%s::date[]) AS d
+            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {column} = d)
+            """,
+            (days,),
+        )
+        stale = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    for day in stale:
+        shutil.rmtree(os.path.join(root, f"{prefix}{day}"))
+    return len(stale)
+
+
+@instrumented("export", name_arg="table")
+def export_gold_model(conn, out_dir, table, days, versions):
+    column = GOLD_MODELS[table]
+    if column is None:
+        with conn.cursor() as cur:
+            version = table_version(cur, table)
+        conn.commit()
+        if versions.get(table) == version:
+            print(f"{table} is unchanged since the last export")
+            return 0
+        rows = write_parquet(
+            conn,
+            f"SELECT * FROM {table}",
+            None,
+            os.path.join(table_dir(out_dir, table), "part-0.parquet"),
+        )
+        versions[table] = version
+        print(f"exported {rows} rows of {table}")
+        return rows
+
+    rows = 0
+    for day in days:
+        rows += write_parquet(
+            conn,
+            f"SELECT * FROM {table} WHERE {column} = %s",
+            (day,),
+            partition_path(out_dir, table, column, day),
+        )
+    pruned = prune_partitions(conn, out_dir, table, column)
+    print(
+        f"exported {rows} rows in {len(days)} partitions of {table}, "
+        f"removed {pruned} empty partitions"
+    )
+    return rows
+
+
+def run_export(conn, out_dir, full=False):
+    if pa is None:
+        raise RuntimeError("the parquet export needs pyarrow (uv sync --extra export)")
+
+    if full:
+        for layer in ("silver", "gold"):
+            shutil.rmtree(os.path.join(out_dir, layer), ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    state = {} if full else load_state(out_dir)
+    silver_state = state.setdefault("silver", {})
+    gold_state = state.setdefault("gold", {})
+    gold_versions = state.setdefault("gold_versions", {})
+
+    # silver partitions are cut on utc days
+    with conn.cursor() as cur:
+        silver_windows = windows_since(
+            cur, silver_state, "silver.watermarks", SILVER_TABLES
+        )
+        gold_windows = windows_since(
+            cur,
+            gold_state,
+            "gold.watermarks",
+            {table: table for table in SILVER_TABLES},
+        )
+        # gold groups by date(event_ts) in the session time zone
+        gold_days = changed_dates(cur, gold_windows, "date(event_ts)")
+    conn.commit()
+
+    started = time.perf_counter()
+    for table, window in silver_windows.items():
+        export_silver_table(conn, out_dir, table, window)
+        silver_state[table] = window[1].isoformat()
+        save_state(out_dir, state)
+
+    if gold_windows:
+        for table in GOLD_MODELS:
+            export_gold_model(conn, out_dir, table, gold_days, gold_versions)
+        for table, (_, high) in gold_windows.items():
+            gold_state[table] = high.isoformat()
+        save_state(out_dir, state)
+
+    print(f"export finished in {time.perf_counter() - started:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export silver and gold to Parquet")
+    parser.add_argument(
+        "--out",
+        default="parquet",
+        help="output directory, laid out as <layer>/<table>/<column>=<date>/",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="forget the export state and rewrite every partition",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        with etl_run(get_pg_conn, "export", args.metrics_jsonl, vars(args)):
+            run_export(conn, args.out, args.full)
+    finally:
+        conn.close()
@@ -0,0 +1,267 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+PERIODS = ("week", "month")
+
+SILVER_TABLES = (
+    "silver.auth_events",
+    "silver.listen_events",
+    "silver.page_view_events",
+    "silver.status_change_events",
+)
+
+DAILY_DATES = """
+SELECT activity_date FROM gold.daily_user_activity
+UNION
+SELECT activity_date FROM gold.daily_geo_activity
+UNION
+SELECT play_date FROM gold.daily_song_plays
+UNION
+SELECT activity_date FROM gold.daily_level_state_users
+"""
+
+# a period with a day built without sketches gets NULL instead of an
+# estimate that silently leaves that day's users out
+SKETCH_MERGE = """CASE WHEN bool_and(d.users_sketch IS NOT NULL)
+            THEN COALESCE(round(hll_cardinality(hll_union_agg(d.users_sketch))), 0)
+        END::integer"""
+
+# every rollup is rebuilt for the periods in rollup_periods only
+ROLLUPS = {
+    "gold.user_activity_rollup": """
+    INSERT INTO gold.user_activity_rollup (
+        period,
+        period_start,
+        active_users,
+        user_days,
+        sessions_count,
+        listens_count,
+        page_views_count
+    )
+    SELECT
+        p.period,
+        p.period_start,
+        COUNT(DISTINCT d.user_id) AS active_users,
+        COUNT(*)                  AS user_days,
+        SUM(d.sessions_count)     AS sessions_count,
+        SUM(d.listens_count)      AS listens_count,
+        SUM(d.page_views_count)   AS page_views_count
+    FROM rollup_periods p
+    JOIN gold.daily_user_activity d
+      ON d.activity_date >= p.period_start
+     AND d.activity_date < p.period_end
+    GROUP BY 1, 2;
+    """,
+    "gold.geo_activity_rollup": f"""
+    INSERT INTO gold.geo_activity_rollup (
+        period,
+        period_start,
+        state,
+        city,
+        user_days,
+        total_events,
+        total_listens,
+        active_users
+    )
+    SELECT
+        p.period,
+        p.period_start,
+        d.state,
+        d.city,
+        SUM(d.active_users)  AS user_days,
+        SUM(d.total_events)  AS total_events,
+        SUM(d.total_listens) AS total_listens,
+        {SKETCH_MERGE} AS active_users
+    FROM rollup_periods p
+    JOIN gold.daily_geo_activity d
+      ON d.activity_date >= p.period_start
+     AND d.activity_date < p.period_end
+    GROUP BY 1, 2, 3, 4;
+    """,
+    "gold.song_plays_rollup": f"""
+    INSERT INTO gold.song_plays_rollup (
+        period,
+        period_start,
+        song_id,
+        plays_count,
+        listener_days,
+        unique_listeners
+    )
+    SELECT
+        p.period,
+        p.period_start,
+        d.song_id,
+        SUM(d.plays_count)  AS plays_count,
+        SUM(d.unique_users) AS listener_days,
+        {SKETCH_MERGE} AS unique_listeners
+    FROM rollup_periods p
+    JOIN gold.daily_song_plays d
+      ON d.play_date >= p.period_start
+     AND d.play_date < p.period_end
+    GROUP BY 1, 2, 3;
+    """,
+    "gold.level_state_cube": """
+    INSERT INTO gold.level_state_cube (
+        period,
+        period_start,
+        level,
+        state,
+        active_users,
+        events_count,
+        listens_count
+    )
+    SELECT
+        p.period,
+        p.period_start,
+        CASE WHEN GROUPING(d.level) = 1 THEN 'all' ELSE d.level END,
+        CASE WHEN GROUPING(d.state) = 1 THEN 'all' ELSE d.state END,
+        COUNT(DISTINCT d.user_id) AS active_users,
+        SUM(d.events_count)       AS events_count,
+        SUM(d.listens_count)      AS listens_count
+    FROM rollup_periods p
+    JOIN gold.daily_level_state_users d
+      ON d.activity_date >= p.period_start
+     AND d.activity_date < p.period_end
+    GROUP BY p.period, p.period_start, CUBE (d.level, d.state);
+    """,
+}
+
+
+def rollup_windows(cur):
+    windows = {}
+    for table in SILVER_TABLES:
+        cur.execute(
+            "SELECT high_water_ts FROM gold.rollup_watermarks WHERE source_table = %s",
+            (table,),
+        )
+        row = cur.fetchone()
+        low = row[0] if row else None
+
+        # the daily models are complete up to the gold watermark
+        cur.execute(
+            "SELECT high_water_ts FROM gold.watermarks WHERE source_table = %s",
+            (table,),
+        )
+        row = cur.fetchone()
+        if row is not None:
+            windows[table] = (low, row[0])
+    return windows
+
+
+def changed_dates_sql(windows):
+    branches = []
+    params = []
+    for table, (low, high) in windows.items():
+        branches.append(
+            f"SELECT date(event_ts) FROM {table} "
+            "WHERE ingestion_ts > %s AND ingestion_ts <= %s"
+        )
+        params.extend([low, high])
+    return " UNION ".join(branches), params
+
+
+def stage_periods(cur, dates_sql, params):
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE rollup_periods ON COMMIT DROP AS
+        SELECT DISTINCT
+            p.period,
+            date_trunc(p.period, d.day)::date AS period_start,
+            (date_trunc(p.period, d.day) + ('1 ' || p.period)::interval)::date
+                AS period_end
+        FROM ({dates_sql}) AS d (day)
+        CROSS JOIN unnest(%s::text[]) AS p (period)
+        """,
+        params + [list(PERIODS)],
+    )
+    cur.execute("ANALYZE rollup_periods")
+    cur.execute("SELECT count(*) FROM rollup_periods")
+    return cur.fetchone()[0]
+
+
+@instrumented("rollup", name_arg="table")
+def build_rollup(conn, table):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            DELETE FROM {table} r
+            USING rollup_periods p
+            WHERE r.period = p.period
+              AND r.period_start = p.period_start
+            """)
+        cur.execute(ROLLUPS[table])
+        return cur.rowcount
+
+
+def save_rollup_watermarks(cur, windows):
+    for table, (_, high) in windows.items():
+        cur.execute(
+            """
+            INSERT INTO gold.rollup_watermarks (source_table, high_water_ts)
+            VALUES (%s, %s)
+            ON CONFLICT (source_table) DO UPDATE SET
+                high_water_ts = EXCLUDED.high_water_ts,
+                updated_at = now()
+            """,
+            (table, high),
+        )
+
+
+def run_rollups(conn, full=False):
+    # one transaction, so the dashboard never sees a half rebuilt period
+    with conn.cursor() as cur:
+        windows = rollup_windows(cur)
+        if not windows:
+            conn.commit()
+            return 0
+
+        # without a watermark (first run, or gold was truncated) every
+        # period of the daily models is rebuilt
+        if full or any(low is None for low, _ in windows.values()):
+            cur.execute(f"TRUNCATE {', '.join(ROLLUPS)}")
+            periods = stage_periods(cur, DAILY_DATES, [])
+        else:
+            periods = stage_periods(cur, *changed_dates_sql(windows))
+        print(f"rebuilding {periods} changed periods")
+
+    rows = 0
+    for table in ROLLUPS:
+        built = build_rollup(conn, table)
+        print(f"rebuilt {built} rows in {table}")
+        rows += built
+
+    with conn.cursor() as cur:
+        save_rollup_watermarks(cur, windows)
+    conn.commit()
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Roll the daily gold models up by week and month"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild every period instead of only the changed ones",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        with etl_run(get_pg_conn, "rollup", args.metrics_jsonl, vars(args)):
+            run_rollups(conn, args.full)
+    finally:
+        conn.close()
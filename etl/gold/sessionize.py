@@ -0,0 +1,286 @@
+import argparse
+import csv
+import heapq
+import io
+import os
+import sys
+from operator import itemgetter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+FETCH_ROWS = 20000
+COPY_ROWS = 50000
+SESSION_TIMEOUT = "30 minutes"
+
+# silver table -> (bronze table of its watermark, page of the event, listens)
+SOURCES = {
+    "silver.page_view_events": ("bronze.page_view_events", "page", 0),
+    "silver.listen_events": ("bronze.listen_events", "'NextSong'", 1),
+    "silver.auth_events": ("bronze.auth_events", "NULL", 0),
+    "silver.status_change_events": ("bronze.status_change_events", "NULL", 0),
+}
+
+WINDOW_SQL = """
+SELECT user_id, event_ts, session_id, {page}::text AS page, city, state,
+       {listens} AS listens
+FROM {table}
+WHERE user_id IS NOT NULL
+  AND session_id IS NOT NULL
+  AND ingestion_ts > %(low)s
+  AND ingestion_ts <= %(high)s
+"""
+
+PART_COLUMNS = (
+    "session_id",
+    "user_id",
+    "session_start_ts",
+    "session_end_ts",
+    "events_count",
+    "listens_count",
+    "city",
+    "state",
+    "entry_page",
+    "exit_page",
+)
+
+# a session seen in several runs (or split by an interleaved session) arrives
+# as several parts; they are folded into one row here and into the existing
+# row on conflict
+MERGE_SQL = """
+INSERT INTO gold.user_sessions AS s (
+    session_id,
+    user_id,
+    session_start_ts,
+    session_end_ts,
+    session_duration_s,
+    events_count,
+    listens_count,
+    city,
+    state,
+    entry_page,
+    exit_page
+)
+SELECT
+    session_id,
+    user_id,
+    MIN(session_start_ts),
+    MAX(session_end_ts),
+    EXTRACT(EPOCH FROM MAX(session_end_ts) - MIN(session_start_ts))::INTEGER,
+    SUM(events_count),
+    SUM(listens_count),
+    (array_agg(city ORDER BY session_start_ts)
+        FILTER (WHERE city IS NOT NULL))[1],
+    (array_agg(state ORDER BY session_start_ts)
+        FILTER (WHERE state IS NOT NULL))[1],
+    (array_agg(entry_page ORDER BY session_start_ts)
+        FILTER (WHERE entry_page IS NOT NULL))[1],
+    (array_agg(exit_page ORDER BY session_end_ts DESC)
+        FILTER (WHERE exit_page IS NOT NULL))[1]
+FROM session_parts
+GROUP BY session_id, user_id
+ON CONFLICT (user_id, session_id) DO UPDATE SET
+    session_start_ts   = LEAST(s.session_start_ts, EXCLUDED.session_start_ts),
+    session_end_ts     = GREATEST(s.session_end_ts, EXCLUDED.session_end_ts),
+    session_duration_s = EXTRACT(EPOCH FROM
+        GREATEST(s.session_end_ts, EXCLUDED.session_end_ts)
+        - LEAST(s.session_start_ts, EXCLUDED.session_start_ts))::INTEGER,
+    events_count       = s.events_count + EXCLUDED.events_count,
+    listens_count      = s.listens_count + EXCLUDED.listens_count,
+    city  = CASE WHEN EXCLUDED.session_start_ts < s.session_start_ts
+                 THEN COALESCE(EXCLUDED.city, s.city)
+                 ELSE COALESCE(s.city, EXCLUDED.city) END,
+    state = CASE WHEN EXCLUDED.session_start_ts < s.session_start_ts
+                 THEN COALESCE(EXCLUDED.state, s.state)
+                 ELSE COALESCE(s.state, EXCLUDED.state) END,
+    entry_page = CASE WHEN EXCLUDED.session_start_ts < s.session_start_ts
+                      THEN COALESCE(EXCLUDED.entry_page, s.entry_page)
+                      ELSE COALESCE(s.entry_page, EXCLUDED.entry_page) END,
+    exit_page  = CASE WHEN EXCLUDED.session_end_ts > s.session_end_ts
+                      THEN COALESCE(EXCLUDED.exit_page, s.exit_page)
+                      ELSE COALESCE(s.exit_page, EXCLUDED.exit_page) END
+"""
+
+# a session is open while its last event is within the timeout of the newest
+# event read and the user has not logged out; open sessions are finished by
+# the next run's parts through the merge above
+MARK_OPEN_SQL = f"""
+UPDATE gold.user_sessions s
+SET is_open = (
+    s.session_end_ts > %(horizon)s - interval '{SESSION_TIMEOUT}'
+    AND s.exit_page IS DISTINCT FROM 'Logout'
+)
+WHERE s.is_open
+   OR (s.user_id, s.session_id) IN (SELECT user_id, session_id FROM session_parts)
+"""
+
+
+def session_windows(cur, full):
+    windows = {}
+    for table, (source, _, _) in SOURCES.items():
+        cur.execute(
+            "SELECT high_water_ts FROM silver.watermarks WHERE source_table = %s",
+            (source,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            continue
+        high = row[0]
+
+        cur.execute(
+            "SELECT high_water_ts FROM gold.session_watermarks WHERE source_table = %s",
+            (table,),
+        )
+        row = cur.fetchone()
+        low = row[0] if row and not full else "-infinity"
+        windows[table] = (low, high)
+    return windows
+
+
+def read_source(conn, table, window):
+    _, page, listens = SOURCES[table]
+    name = f"sessionize_{table.split('.')[1]}"
+    sql = WINDOW_SQL.format(table=table, page=page, listens=listens)
+    params = {"low": window[0], "high": window[1]}
+    if window[0] != "-infinity":
+        # an incremental window is found through the ingestion_ts BRIN index and staged,
+        # so only its rows are sorted; the (user_id, event_ts) index would
+        # be walked from end to end to filter them out
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE {name} ON COMMIT DROP AS {sql}", params)
+            cur.execute(f"ANALYZE {name}")
+        sql, params = f"SELECT * FROM {name}", None
+
+    # a named cursor per table streams its rows in (user_id, event_ts) order,
+    # off the (user_id, event_ts) index when all of silver is read,
+    # FETCH_ROWS at a time
+    cur = conn.cursor(name=name)
+    cur.itersize = FETCH_ROWS
+    cur.execute(f"{sql} ORDER BY user_id, event_ts", params)
+    return cur
+
+
+def sessionize(events):
+    # events are merged across tables in (user_id, event_ts) order, so a
+    # session ends as soon as the user or session id changes and only the
+    # current one is ever held in memory
+    current = None
+    for user_id, event_ts, session_id, page, city, state, listens in events:
+        if current is None or current[1] != user_id or current[0] != session_id:
+            if current is not None:
+                yield current
+            current = [session_id, user_id, event_ts, event_ts, 0, 0]
+            current += [city, state, None, None]
+        current[3] = event_ts
+        current[4] += 1
+        current[5] += listens
+        if current[6] is None:
+            current[6], current[7] = city, state
+        if page is not None:
+            if current[8] is None:
+                current[8] = page
+            current[9] = page
+    if current is not None:
+        yield current
+
+
+def copy_parts(cur, rows):
+    buf = io.StringIO()
+    # everything but None is quoted, so only NULLs become unquoted empty fields
+    csv.writer(buf, quoting=csv.QUOTE_NOTNULL).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY session_parts ({', '.join(PART_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buf,
+    )
+
+
+def save_session_watermarks(cur, windows):
+    for table, (_, high) in windows.items():
+        cur.execute(
+            """
+            INSERT INTO gold.session_watermarks (source_table, high_water_ts)
+            VALUES (%s, %s)
+            ON CONFLICT (source_table) DO UPDATE SET
+                high_water_ts = EXCLUDED.high_water_ts,
+                updated_at = now()
+            """,
+            (table, high),
+        )
+
+
+@instrumented("gold")
+def run_sessionize(conn, full=False):
+    # one transaction: the merge adds to existing sessions, so the parts and
+    # the watermarks that exclude them next time must commit together
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('gold.user_sessions'))")
+        if full:
+            cur.execute("TRUNCATE gold.user_sessions, gold.session_watermarks")
+        windows = session_windows(cur, full)
+        cur.execute(f"""
+            CREATE TEMP TABLE session_parts ON COMMIT DROP AS
+            SELECT {', '.join(PART_COLUMNS)} FROM gold.user_sessions WITH NO DATA
+            """)
+
+    readers = [read_source(conn, table, window) for table, window in windows.items()]
+    events = heapq.merge(*readers, key=itemgetter(0, 1))
+
+    parts = 0
+    horizon = None
+    with conn.cursor() as cur:
+        batch = []
+        for part in sessionize(events):
+            batch.append(part)
+            if horizon is None or part[3] > horizon:
+                horizon = part[3]
+            if len(batch) >= COPY_ROWS:
+                copy_parts(cur, batch)
+                parts += len(batch)
+                batch = []
+        if batch:
+            copy_parts(cur, batch)
+            parts += len(batch)
+    for reader in readers:
+        reader.close()
+
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE session_parts")
+        cur.execute(MERGE_SQL)
+        merged = cur.rowcount
+        if horizon is not None:
+            cur.execute(MARK_OPEN_SQL, {"horizon": horizon})
+            cur.execute("SELECT count(*) FROM gold.user_sessions WHERE is_open")
+            print(f"{cur.fetchone()[0]} sessions left open for the next run")
+        save_session_watermarks(cur, windows)
+    conn.commit()
+    print(f"merged {parts} session parts into {merged} rows of gold.user_sessions")
+    return merged
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build gold.user_sessions in one ordered pass over silver"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="truncate gold.user_sessions and sessionize all of silver",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        with etl_run(get_pg_conn, "sessionize", args.metrics_jsonl, vars(args)):
+            run_sessionize(conn, args.full)
+    finally:
+        conn.close()
@@ -1,6 +1,32 @@
-import psycopg2
+import argparse
 import os
-import time
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from layers import load_module  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+# bytes scanned per model, collected by execute_model when --report-io is set
+IO_REPORT = None
+BLOCK_SIZE = 8192
+SKETCHES = False
+# gold.user_sessions is left to gold/sessionize.py when set
+STREAM_SESSIONS = False
+FUNNEL_ENGINES = ("ordered", "window")
+FUNNEL_ENGINE = "ordered"
+
+# models that merge with ON CONFLICT need their primary key during the load
+UPSERT_MODELS = ("gold.user_sessions", "gold.user_lifetime_metrics")
+INDEX_DEF = re.compile(r"^CREATE (UNIQUE )?INDEX (\S+) ON (\S+) (.*)$")
+
+# tables a model's build also writes, cleared together with it
+BY_PRODUCTS = {
+    "gold.subscription_funnel_daily": (
+        ("gold.subscription_transitions", "event_date"),
+    ),
+}
 
 
 def truncate_gold(conn):
@@ -10,8 +36,13 @@ def truncate_gold(conn):
         gold.daily_song_plays,
         gold.user_sessions,
         gold.subscription_funnel_daily,
+        gold.subscription_transitions,
         gold.daily_geo_activity,
-        gold.user_lifetime_metrics
+        gold.daily_level_state_users,
+        gold.user_lifetime_metrics,
+        gold.watermarks,
+        gold.rollup_watermarks,
+        gold.session_watermarks
     RESTART IDENTITY;
     """
     with conn.cursor() as cur:
@@ -19,21 +50,120 @@ def truncate_gold(conn):
     conn.commit()
 
 
-def build_daily_user_activity(conn):
+def truncate_model(conn, table):
+    tables = [table] + [name for name, _ in BY_PRODUCTS.get(table, ())]
+    with conn.cursor() as cur:
+        cur.execute(f"TRUNCATE TABLE {', '.join(tables)}")
+    conn.commit()
+
+
+def scanned_blocks(plan):
+    blocks = 0
+    if "Relation Name" in plan and plan["Node Type"] != "ModifyTable":
+        blocks += plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+    for child in plan.get("Plans", []):
+        blocks += scanned_blocks(child)
+    return blocks
+
+
+def scanned_bytes(plan, block_size):
+    return scanned_blocks(plan) * block_size
+
+
+def source_rows(plan):
+    # rows fed into the statement's own ModifyTable; a data-modifying CTE
+    # hangs off it as an InitPlan child and is not counted
+    if plan["Node Type"] != "ModifyTable":
+        return 0
+    return sum(
+        child["Actual Rows"]
+        for child in plan.get("Plans", [])
+        if child.get("Parent Relationship") == "Outer"
+    )
+
+
+def execute_model(cur, name, sql, shadows=None):
+    # shadows maps live tables to the unlogged shadows a --swap rebuild
+    # writes instead
+    for table, shadow in (shadows or {}).items():
+        sql = re.sub(rf"\b{re.escape(table)}\b", shadow, sql)
+    if IO_REPORT is None:
+        cur.execute(sql)
+        return cur.rowcount
+
+    # EXPLAIN ANALYZE runs the statement, and its per-node buffer counts tell
+    # exactly how much of each scanned relation the model touched
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql)
+    plan = cur.fetchone()[0][0]["Plan"]
+    IO_REPORT[name] = IO_REPORT.get(name, 0) + scanned_bytes(plan, BLOCK_SIZE)
+    return source_rows(plan)
+
+
+def enable_sketches():
+    global SKETCHES
+    SKETCHES = True
+
+
+def enable_stream_sessions():
+    global STREAM_SESSIONS
+    STREAM_SESSIONS = True
+
+
+def set_funnel_engine(engine):
+    global FUNNEL_ENGINE
+    FUNNEL_ENGINE = engine
+
+
+def distinct_aggregates(column):
+    # with sketches on, the distinct count is read off the sketch instead of
+    # a separate COUNT(DISTINCT), postgres computes the aggregate once
+    if not SKETCHES:
+        return {"distinct": f"COUNT(DISTINCT {column})", "sketch": "NULL::integer[]"}
+    # NULLs are left out like COUNT(DISTINCT) leaves them out; a group with
+    # none left gets an empty sketch, NULL means built without sketches
+    sketch = (
+        f"COALESCE(hll_compact(array_agg(hll_item({column})) "
+        f"FILTER (WHERE {column} IS NOT NULL)), '{{}}')"
+    )
+    return {
+        "distinct": f"COALESCE(round(hll_cardinality({sketch})), 0)::integer",
+        "sketch": sketch,
+    }
+
+
+def enable_io_report(conn):
+    global IO_REPORT, BLOCK_SIZE
+    with conn.cursor() as cur:
+        cur.execute("SELECT current_setting('block_size')::int")
+        BLOCK_SIZE = cur.fetchone()[0]
+    IO_REPORT = {}
+
+
+def print_io_report():
+    for name, scanned in IO_REPORT.items():
+        print(f"{name:<32} {scanned / 1024 / 1024:>10.1f} MiB read")
+    total = sum(IO_REPORT.values())
+    print(f"{'total':<32} {total / 1024 / 1024:>10.1f} MiB read")
+
+
+@instrumented("gold")
+def build_daily_user_activity(conn, scope="TRUE", shadows=None):
     sql = """
     INSERT INTO gold.daily_user_activity (
         activity_date,
         user_id,
         sessions_count,
         listens_count,
-        page_views_count
+        page_views_count,
+        sessions_sketch
     )
     SELECT
         activity_date,
         user_id,
-        COUNT(DISTINCT session_id) AS sessions_count,
+        {distinct}                 AS sessions_count,
         SUM(listens_count)         AS listens_count,
-        SUM(page_views_count)      AS page_views_count
+        SUM(page_views_count)      AS page_views_count,
+        {sketch}                   AS sessions_sketch
     FROM (
         SELECT
             date(event_ts) AS activity_date,
@@ -43,6 +173,7 @@ def build_daily_user_activity(conn):
             0        AS page_views_count
         FROM silver.listen_events
         WHERE user_id IS NOT NULL
+          AND {scope}
         GROUP BY 1, 2, 3
 
         UNION ALL
@@ -55,43 +186,54 @@ def build_daily_user_activity(conn):
             COUNT(*)
         FROM silver.page_view_events
         WHERE user_id IS NOT NULL
+          AND {scope}
         GROUP BY 1, 2, 3
     ) t
     GROUP BY activity_date, user_id;
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
-    conn.commit()
+        return execute_model(
+            cur,
+            "gold.daily_user_activity",
+            sql.format(scope=scope, **distinct_aggregates("session_id")),
+            shadows,
+        )
 
 
-def build_daily_song_plays(conn):
+@instrumented("gold")
+def build_daily_song_plays(conn, scope="TRUE", shadows=None):
     sql = """
     INSERT INTO gold.daily_song_plays (
         play_date,
-        artist,
-        song,
+        song_id,
         plays_count,
-        unique_users
+        unique_users,
+        users_sketch
     )
     SELECT
         date(event_ts) AS play_date,
-        artist,
-        song,
+        song_id,
         COUNT(*)                  AS plays_count,
-        COUNT(DISTINCT user_id)   AS unique_users
+        {distinct}                AS unique_users,
+        {sketch}                  AS users_sketch
     FROM silver.listen_events
-    WHERE artist IS NOT NULL
-      AND song IS NOT NULL
-    GROUP BY 1, 2, 3;
+    WHERE song_id IS NOT NULL
+      AND {scope}
+    GROUP BY 1, 2;
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
-    conn.commit()
+        return execute_model(
+            cur,
+            "gold.daily_song_plays",
+            sql.format(scope=scope, **distinct_aggregates("user_id")),
+            shadows,
+        )
 
 
-def build_user_sessions(conn):
+@instrumented("gold")
+def build_user_sessions(conn, scope="TRUE", shadows=None):
     sql = """
     INSERT INTO gold.user_sessions (
         session_id,
@@ -119,34 +261,149 @@ def build_user_sessions(conn):
         SELECT session_id, user_id, event_ts, city, state, 0 AS listens
         FROM silver.page_view_events
         WHERE user_id IS NOT NULL
+          AND {scope}
 
         UNION ALL
 
         SELECT session_id, user_id, event_ts, city, state, 1
         FROM silver.listen_events
         WHERE user_id IS NOT NULL
+          AND {scope}
 
         UNION ALL
 
         SELECT session_id, user_id, event_ts, city, state, 0
         FROM silver.auth_events
         WHERE user_id IS NOT NULL
+          AND {scope}
 
         UNION ALL
 
         SELECT session_id, user_id, event_ts, city, state, 0
         FROM silver.status_change_events
         WHERE user_id IS NOT NULL
+          AND {scope}
     ) t
-    GROUP BY session_id, user_id;
+    GROUP BY session_id, user_id
+    ON CONFLICT (user_id, session_id) DO UPDATE SET
+        session_start_ts   = EXCLUDED.session_start_ts,
+        session_end_ts     = EXCLUDED.session_end_ts,
+        session_duration_s = EXCLUDED.session_duration_s,
+        events_count       = EXCLUDED.events_count,
+        listens_count      = EXCLUDED.listens_count,
+        city               = EXCLUDED.city,
+        state              = EXCLUDED.state;
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
-    conn.commit()
+        return execute_model(
+            cur, "gold.user_sessions", sql.format(scope=scope), shadows
+        )
+
+
+FUNNEL_EVENTS = """
+SELECT date(event_ts) AS event_date, event_ts, user_id, level, TRUE AS had_auth_event
+FROM silver.auth_events
+WHERE user_id IS NOT NULL
+  AND {scope}
+
+UNION ALL
+
+SELECT date(event_ts), event_ts, user_id, level, FALSE
+FROM silver.status_change_events
+WHERE user_id IS NOT NULL
+  AND {scope}
+"""
+
+# one sort of the events by (user_id, event_date, event_ts) feeds a group
+# aggregate, which collects every user-day's levels in event order; first and
+# last level are the ends of that array and the transitions are its changes.
+# A day boundary transition compares with the user's previous day, from this
+# build or from the untouched days left in the table; the boundary of a
+# user's next untouched day is not revisited when a day is rebuilt.
+ORDERED_FUNNEL = """
+WITH days AS (
+    SELECT
+        event_date,
+        user_id,
+        array_agg(level ORDER BY event_ts) AS levels,
+        BOOL_OR(had_auth_event)            AS had_auth_event
+    FROM ({events}) e
+    GROUP BY user_id, event_date
+),
+boundaries AS (
+    SELECT
+        d.event_date,
+        d.user_id,
+        d.levels[1] AS first_level,
+        lag(d.event_date) OVER w AS prev_date,
+        lag(d.levels[cardinality(d.levels)]) OVER w AS prev_level
+    FROM days d
+    WINDOW w AS (PARTITION BY d.user_id ORDER BY d.event_date)
+),
+steps AS (
+    SELECT d.event_date, d.user_id, d.levels[i - 1] AS from_level,
+           d.levels[i] AS to_level
+    FROM days d
+    CROSS JOIN LATERAL generate_series(2, cardinality(d.levels)) AS i
+
+    UNION ALL
+
+    SELECT
+        b.event_date,
+        b.user_id,
+        CASE WHEN t.event_date IS NULL OR b.prev_date > t.event_date
+             THEN b.prev_level ELSE t.last_level END,
+        b.first_level
+    FROM boundaries b
+    LEFT JOIN LATERAL (
+        SELECT p.event_date, p.last_level
+        FROM gold.subscription_funnel_daily p
+        WHERE p.user_id = b.user_id
+          AND p.event_date < b.event_date
+        ORDER BY p.event_date DESC
+        LIMIT 1
+    ) t ON TRUE
+),
+transitions AS (
+    INSERT INTO gold.subscription_transitions (
+        event_date,
+        user_id,
+        from_level,
+        to_level,
+        transitions
+    )
+    SELECT event_date, user_id, from_level, to_level, COUNT(*)
+    FROM steps
+    WHERE from_level <> to_level
+    GROUP BY 1, 2, 3, 4
+)
+INSERT INTO gold.subscription_funnel_daily (
+    event_date,
+    user_id,
+    first_level,
+    last_level,
+    had_auth_event
+)
+SELECT
+    event_date,
+    user_id,
+    levels[1],
+    levels[cardinality(levels)],
+    had_auth_event
+FROM days;
+"""
 
 
-def build_subscription_funnel_daily(conn):
+@instrumented("gold")
+def build_subscription_funnel_daily(conn, scope="TRUE", shadows=None):
+    if FUNNEL_ENGINE == "ordered":
+        sql = ORDERED_FUNNEL.format(events=FUNNEL_EVENTS)
+        with conn.cursor() as cur:
+            return execute_model(
+                cur, "gold.subscription_funnel_daily", sql.format(scope=scope), shadows
+            )
+
     sql = """
     INSERT INTO gold.subscription_funnel_daily (
         event_date,
@@ -164,6 +421,7 @@ def build_subscription_funnel_daily(conn):
             TRUE AS had_auth_event
         FROM silver.auth_events
         WHERE user_id IS NOT NULL
+          AND {scope}
 
         UNION ALL
 
@@ -175,6 +433,7 @@ def build_subscription_funnel_daily(conn):
             FALSE
         FROM silver.status_change_events
         WHERE user_id IS NOT NULL
+          AND {scope}
     ),
     windowed AS (
         SELECT
@@ -205,12 +464,13 @@ def build_subscription_funnel_daily(conn):
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
-
-    conn.commit()
+        return execute_model(
+            cur, "gold.subscription_funnel_daily", sql.format(scope=scope), shadows
+        )
 
 
-def build_daily_geo_activity(conn):
+@instrumented("gold")
+def build_daily_geo_activity(conn, scope="TRUE", shadows=None):
     sql = """
     INSERT INTO gold.daily_geo_activity (
         activity_date,
@@ -218,33 +478,39 @@ def build_daily_geo_activity(conn):
         city,
         active_users,
         total_events,
-        total_listens
+        total_listens,
+        users_sketch
     )
     SELECT
         date(event_ts) AS activity_date,
         state,
         city,
-        COUNT(DISTINCT user_id) AS active_users,
+        {distinct}              AS active_users,
         COUNT(*)                AS total_events,
-        SUM(listens)            AS total_listens
+        SUM(listens)            AS total_listens,
+        {sketch}                AS users_sketch
     FROM (
         SELECT event_ts, user_id, city, state, 0 AS listens
         FROM silver.page_view_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT event_ts, user_id, city, state, 1
         FROM silver.listen_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT event_ts, user_id, city, state, 0
         FROM silver.auth_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT event_ts, user_id, city, state, 0
         FROM silver.status_change_events
+        WHERE {scope}
     ) t
     WHERE city IS NOT NULL
       AND state IS NOT NULL
@@ -252,11 +518,69 @@ def build_daily_geo_activity(conn):
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
-    conn.commit()
+        return execute_model(
+            cur,
+            "gold.daily_geo_activity",
+            sql.format(scope=scope, **distinct_aggregates("user_id")),
+            shadows,
+        )
 
 
-def build_user_lifetime_metrics(conn):
+@instrumented("gold")
+def build_daily_level_state_users(conn, scope="TRUE", shadows=None):
+    sql = """
+    INSERT INTO gold.daily_level_state_users (
+        activity_date,
+        level,
+        state,
+        user_id,
+        events_count,
+        listens_count
+    )
+    SELECT
+        date(event_ts) AS activity_date,
+        level,
+        state,
+        user_id,
+        COUNT(*)     AS events_count,
+        SUM(listens) AS listens_count
+    FROM (
+        SELECT event_ts, user_id, level, state, 0 AS listens
+        FROM silver.page_view_events
+        WHERE {scope}
+
+        UNION ALL
+
+        SELECT event_ts, user_id, level, state, 1
+        FROM silver.listen_events
+        WHERE {scope}
+
+        UNION ALL
+
+        SELECT event_ts, user_id, level, state, 0
+        FROM silver.auth_events
+        WHERE {scope}
+
+        UNION ALL
+
+        SELECT event_ts, user_id, level, state, 0
+        FROM silver.status_change_events
+        WHERE {scope}
+    ) t
+    WHERE user_id IS NOT NULL
+      AND level IS NOT NULL
+      AND state IS NOT NULL
+    GROUP BY 1, 2, 3, 4;
+    """
+
+    with conn.cursor() as cur:
+        return execute_model(
+            cur, "gold.daily_level_state_users", sql.format(scope=scope), shadows
+        )
+
+
+@instrumented("gold")
+def build_user_lifetime_metrics(conn, scope="TRUE", shadows=None):
     sql = """
     INSERT INTO gold.user_lifetime_metrics (
         user_id,
@@ -278,74 +602,778 @@ def build_user_lifetime_metrics(conn):
     FROM (
         SELECT user_id, session_id, event_ts, 0 AS listens, 1 AS page_views
         FROM silver.page_view_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT user_id, session_id, event_ts, 1, 0
         FROM silver.listen_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT user_id, session_id, event_ts, 0, 0
         FROM silver.auth_events
+        WHERE {scope}
 
         UNION ALL
 
         SELECT user_id, session_id, event_ts, 0, 0
         FROM silver.status_change_events
+        WHERE {scope}
     ) t
     WHERE user_id IS NOT NULL
-    GROUP BY user_id;
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        first_seen_ts    = EXCLUDED.first_seen_ts,
+        last_seen_ts     = EXCLUDED.last_seen_ts,
+        total_sessions   = EXCLUDED.total_sessions,
+        total_listens    = EXCLUDED.total_listens,
+        total_page_views = EXCLUDED.total_page_views,
+        days_active      = EXCLUDED.days_active;
     """
 
     with conn.cursor() as cur:
-        cur.execute(sql)
+        return execute_model(
+            cur, "gold.user_lifetime_metrics", sql.format(scope=scope), shadows
+        )
+
+
+SILVER_SOURCES = {
+    "silver.auth_events": "bronze.auth_events",
+    "silver.listen_events": "bronze.listen_events",
+    "silver.page_view_events": "bronze.page_view_events",
+    "silver.status_change_events": "bronze.status_change_events",
+}
+
+# dates, sessions and users with new silver rows, staged by stage_touched_keys
+DATE_SCOPE = """
+    event_ts >= (SELECT min(event_date) FROM gold_touched_dates)
+    AND event_ts < (SELECT max(event_date) + 1 FROM gold_touched_dates)
+    AND date(event_ts) IN (SELECT event_date FROM gold_touched_dates)
+"""
+SESSION_SCOPE = """
+    (user_id, session_id) IN (SELECT user_id, session_id FROM gold_touched_sessions)
+"""
+USER_SCOPE = "user_id IN (SELECT user_id FROM gold_touched_users)"
+
+SILVER_BUILDERS = {
+    "gold.daily_user_activity": build_daily_user_activity,
+    "gold.daily_song_plays": build_daily_song_plays,
+    "gold.user_sessions": build_user_sessions,
+    "gold.subscription_funnel_daily": build_subscription_funnel_daily,
+    "gold.daily_geo_activity": build_daily_geo_activity,
+    "gold.daily_level_state_users": build_daily_level_state_users,
+    "gold.user_lifetime_metrics": build_user_lifetime_metrics,
+}
+
+DATE_MODELS = (
+    ("gold.daily_user_activity", "activity_date"),
+    ("gold.daily_song_plays", "play_date"),
+    ("gold.subscription_funnel_daily", "event_date"),
+    ("gold.daily_geo_activity", "activity_date"),
+    ("gold.daily_level_state_users", "activity_date"),
+)
+
+# event_type codes in staging.gold_events
+AUTH, LISTEN, PAGE_VIEW, STATUS_CHANGE = 1, 2, 3, 4
+
+STREAM_SOURCES = (
+    (AUTH, "silver.auth_events", "NULL"),
+    (LISTEN, "silver.listen_events", "song_id"),
+    (PAGE_VIEW, "silver.page_view_events", "song_id"),
+    (STATUS_CHANGE, "silver.status_change_events", "NULL"),
+)
+
+STREAM_FUNNEL_EVENTS = f"""
+SELECT date(event_ts) AS event_date, event_ts, user_id, level,
+       event_type = {AUTH} AS had_auth_event
+FROM staging.gold_events
+WHERE event_type IN ({AUTH}, {STATUS_CHANGE})
+  AND user_id IS NOT NULL
+  AND {{scope}}
+"""
+
+# column behind the {distinct} and {sketch} placeholders of a stream model
+STREAM_DISTINCT = {"gold.daily_user_activity": "session_id"}
+
+STREAM_MODELS = {
+    "gold.daily_user_activity": f"""
+    INSERT INTO gold.daily_user_activity (
+        activity_date,
+        user_id,
+        sessions_count,
+        listens_count,
+        page_views_count,
+        sessions_sketch
+    )
+    SELECT
+        date(event_ts) AS activity_date,
+        user_id,
+        {{distinct}}                                      AS sessions_count,
+        COUNT(*) FILTER (WHERE event_type = {LISTEN})     AS listens_count,
+        COUNT(*) FILTER (WHERE event_type = {PAGE_VIEW})  AS page_views_count,
+        {{sketch}}                                        AS sessions_sketch
+    FROM staging.gold_events
+    WHERE event_type IN ({LISTEN}, {PAGE_VIEW})
+      AND user_id IS NOT NULL
+      AND {{scope}}
+    GROUP BY 1, 2;
+    """,
+    "gold.daily_song_plays": f"""
+    INSERT INTO gold.daily_song_plays (
+        play_date,
+        song_id,
+        plays_count,
+        unique_users,
+        users_sketch
+    )
+    SELECT
+        date(event_ts) AS play_date,
+        song_id,
+        COUNT(*)                  AS plays_count,
+        {{distinct}}              AS unique_users,
+        {{sketch}}                AS users_sketch
+    FROM staging.gold_events
+    WHERE event_type = {LISTEN}
+      AND song_id IS NOT NULL
+      AND {{scope}}
+    GROUP BY 1, 2;
+    """,
+    "gold.user_sessions": f"""
+    INSERT INTO gold.user_sessions (
+        session_id,
+        user_id,
+        session_start_ts,
+        session_end_ts,
+        session_duration_s,
+        events_count,
+        listens_count,
+        city,
+        state
+    )
+    SELECT
+        session_id,
+        user_id,
+        MIN(event_ts) AS session_start_ts,
+        MAX(event_ts) AS session_end_ts,
+        EXTRACT(EPOCH FROM MAX(event_ts) - MIN(event_ts))::INTEGER
+            AS session_duration_s,
+        COUNT(*)      AS events_count,
+        COUNT(*) FILTER (WHERE event_type = {LISTEN}) AS listens_count,
+        MAX(city)     AS city,
+        MAX(state)    AS state
+    FROM staging.gold_events
+    WHERE user_id IS NOT NULL
+      AND {{scope}}
+    GROUP BY session_id, user_id
+    ON CONFLICT (user_id, session_id) DO UPDATE SET
+        session_start_ts   = EXCLUDED.session_start_ts,
+        session_end_ts     = EXCLUDED.session_end_ts,
+        session_duration_s = EXCLUDED.session_duration_s,
+        events_count       = EXCLUDED.events_count,
+        listens_count      = EXCLUDED.listens_count,
+        city               = EXCLUDED.city,
+        state              = EXCLUDED.state;
+    """,
+    "gold.subscription_funnel_daily": f"""
+    INSERT INTO gold.subscription_funnel_daily (
+        event_date,
+        user_id,
+        first_level,
+        last_level,
+        had_auth_event
+    )
+    WITH windowed AS (
+        SELECT
+            date(event_ts) AS event_date,
+            user_id,
+            FIRST_VALUE(level) OVER w AS first_level,
+            LAST_VALUE(level)  OVER w AS last_level,
+            event_type = {AUTH}       AS had_auth_event
+        FROM staging.gold_events
+        WHERE event_type IN ({AUTH}, {STATUS_CHANGE})
+          AND user_id IS NOT NULL
+          AND {{scope}}
+        WINDOW w AS (
+            PARTITION BY date(event_ts), user_id
+            ORDER BY event_ts
+            ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+        )
+    )
+    SELECT
+        event_date,
+        user_id,
+        first_level,
+        last_level,
+        BOOL_OR(had_auth_event) AS had_auth_event
+    FROM windowed
+    GROUP BY
+        event_date,
+        user_id,
+        first_level,
+        last_level;
+    """,
+    "gold.daily_geo_activity": f"""
+    INSERT INTO gold.daily_geo_activity (
+        activity_date,
+        state,
+        city,
+        active_users,
+        total_events,
+        total_listens,
+        users_sketch
+    )
+    SELECT
+        date(event_ts) AS activity_date,
+        state,
+        city,
+        {{distinct}}            AS active_users,
+        COUNT(*)                AS total_events,
+        COUNT(*) FILTER (WHERE event_type = {LISTEN}) AS total_listens,
+        {{sketch}}              AS users_sketch
+    FROM staging.gold_events
+    WHERE city IS NOT NULL
+      AND state IS NOT NULL
+      AND {{scope}}
+    GROUP BY 1, 2, 3;
+    """,
+    "gold.daily_level_state_users": f"""
+    INSERT INTO gold.daily_level_state_users (
+        activity_date,
+        level,
+        state,
+        user_id,
+        events_count,
+        listens_count
+    )
+    SELECT
+        date(event_ts) AS activity_date,
+        level,
+        state,
+        user_id,
+        COUNT(*)                                      AS events_count,
+        COUNT(*) FILTER (WHERE event_type = {LISTEN}) AS listens_count
+    FROM staging.gold_events
+    WHERE user_id IS NOT NULL
+      AND level IS NOT NULL
+      AND state IS NOT NULL
+      AND {{scope}}
+    GROUP BY 1, 2, 3, 4;
+    """,
+    "gold.user_lifetime_metrics": f"""
+    INSERT INTO gold.user_lifetime_metrics (
+        user_id,
+        first_seen_ts,
+        last_seen_ts,
+        total_sessions,
+        total_listens,
+        total_page_views,
+        days_active
+    )
+    SELECT
+        user_id,
+        MIN(event_ts)                                    AS first_seen_ts,
+        MAX(event_ts)                                    AS last_seen_ts,
+        COUNT(DISTINCT session_id)                       AS total_sessions,
+        COUNT(*) FILTER (WHERE event_type = {LISTEN})    AS total_listens,
+        COUNT(*) FILTER (WHERE event_type = {PAGE_VIEW}) AS total_page_views,
+        COUNT(DISTINCT date(event_ts))                   AS days_active
+    FROM staging.gold_events
+    WHERE user_id IS NOT NULL
+      AND {{scope}}
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        first_seen_ts    = EXCLUDED.first_seen_ts,
+        last_seen_ts     = EXCLUDED.last_seen_ts,
+        total_sessions   = EXCLUDED.total_sessions,
+        total_listens    = EXCLUDED.total_listens,
+        total_page_views = EXCLUDED.total_page_views,
+        days_active      = EXCLUDED.days_active;
+    """,
+}
+
+
+@instrumented("gold")
+def stage_gold_events(conn, scope="TRUE"):
+    # the one pass over silver: every model below reads this narrow copy
+    branches = [f"""
+        SELECT
+            {event_type}::smallint, event_ts, user_id, session_id,
+            level, {song_id}, city, state
+        FROM {table}
+        WHERE {scope}
+        """ for event_type, table, song_id in STREAM_SOURCES]
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE staging.gold_events")
+        staged = execute_model(
+            cur,
+            "staging.gold_events",
+            f"""
+            INSERT INTO staging.gold_events (
+                event_type, event_ts, user_id, session_id,
+                level, song_id, city, state
+            )
+            {" UNION ALL ".join(branches)}
+            """,
+        )
+        cur.execute("ANALYZE staging.gold_events")
+    print(f"staged {staged} silver events in staging.gold_events")
+    return staged
+
+
+def stream_builder(table):
+    @instrumented("gold", stage=f"build_from_stream[{table}]")
+    def build(conn, scope="TRUE", shadows=None):
+        template = STREAM_MODELS[table]
+        if table == "gold.subscription_funnel_daily" and FUNNEL_ENGINE == "ordered":
+            template = ORDERED_FUNNEL.format(events=STREAM_FUNNEL_EVENTS)
+        with conn.cursor() as cur:
+            sql = template.format(
+                scope=scope,
+                **distinct_aggregates(STREAM_DISTINCT.get(table, "user_id")),
+            )
+            return execute_model(cur, table, sql, shadows)
+
+    return build
+
+
+def model_builders(single_scan):
+    builders = SILVER_BUILDERS
+    if single_scan:
+        builders = {table: stream_builder(table) for table in SILVER_BUILDERS}
+    if STREAM_SESSIONS:
+        builders = {k: v for k, v in builders.items() if k != "gold.user_sessions"}
+    return builders
+
+
+def gold_windows(cur):
+    windows = {}
+    for table, source in SILVER_SOURCES.items():
+        cur.execute(
+            "SELECT high_water_ts FROM gold.watermarks WHERE source_table = %s",
+            (table,),
+        )
+        row = cur.fetchone()
+        low = row[0] if row else "-infinity"
+
+        # silver advances its own watermark in the same transaction as the
+        # rows it inserts, so everything up to it is committed
+        cur.execute(
+            "SELECT high_water_ts FROM silver.watermarks WHERE source_table = %s",
+            (source,),
+        )
+        row = cur.fetchone()
+        if row is not None:
+            windows[table] = (low, row[0])
+    return windows
+
+
+def save_gold_watermarks(cur, windows):
+    for table, (_, high) in windows.items():
+        cur.execute(
+            """
+            INSERT INTO gold.watermarks (source_table, high_water_ts)
+            VALUES (%s, %s)
+            ON CONFLICT (source_table) DO UPDATE SET
+                high_water_ts = EXCLUDED.high_water_ts,
+                updated_at = now()
+            """,
+            (table, high),
+        )
+
+
+def stage_touched_keys(cur, windows):
+    branches = []
+    params = []
+    for table, (low, high) in windows.items():
+        branches.append(f"""
+            SELECT event_ts, user_id, session_id
+            FROM {table}
+            WHERE ingestion_ts > %s AND ingestion_ts <= %s
+            """)
+        params.extend([low, high])
+
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE gold_delta ON COMMIT DROP AS
+        SELECT DISTINCT date(event_ts) AS event_date, user_id, session_id
+        FROM ({" UNION ALL ".join(branches)}) t
+        """,
+        params,
+    )
+    cur.execute("""
+        CREATE TEMP TABLE gold_touched_dates ON COMMIT DROP AS
+        SELECT DISTINCT event_date FROM gold_delta;
+
+        CREATE TEMP TABLE gold_touched_sessions ON COMMIT DROP AS
+        SELECT DISTINCT user_id, session_id
+        FROM gold_delta
+        WHERE user_id IS NOT NULL;
+
+        CREATE TEMP TABLE gold_touched_users ON COMMIT DROP AS
+        SELECT DISTINCT user_id
+        FROM gold_delta
+        WHERE user_id IS NOT NULL;
+
+        ANALYZE gold_touched_dates;
+        ANALYZE gold_touched_sessions;
+        ANALYZE gold_touched_users;
+        """)
+    cur.execute("SELECT count(*) FROM gold_touched_dates")
+    return cur.fetchone()[0]
+
+
+def run_gold_incremental(conn, single_scan=False):
+    # one transaction: readers keep seeing the previous version of every
+    # touched partition until the rebuilt one is committed
+    with conn.cursor() as cur:
+        windows = gold_windows(cur)
+        if not windows:
+            conn.commit()
+            return
+
+        touched = stage_touched_keys(cur, windows)
+        print(f"rebuilding {touched} touched dates in gold")
+
+    builders = model_builders(single_scan)
+    if single_scan:
+        stage_gold_events(
+            conn, f"({DATE_SCOPE}) OR ({SESSION_SCOPE}) OR ({USER_SCOPE})"
+        )
+
+    for table, date_column in DATE_MODELS:
+        by_products = BY_PRODUCTS.get(table, ())
+        if FUNNEL_ENGINE == "window":
+            # the window build does not write the transitions, so their
+            # touched dates are kept instead of being cleared for good
+            by_products = ()
+        with conn.cursor() as cur:
+            for name, column in ((table, date_column),) + by_products:
+                cur.execute(f"""
+                    DELETE FROM {name}
+                    WHERE {column} IN (SELECT event_date FROM gold_touched_dates)
+                    """)
+        print(f"rebuilt {builders[table](conn, DATE_SCOPE)} rows in {table}")
+
+    for table, scope in (
+        ("gold.user_sessions", SESSION_SCOPE),
+        ("gold.user_lifetime_metrics", USER_SCOPE),
+    ):
+        if table not in builders:
+            continue
+        print(f"merged {builders[table](conn, scope)} rows in {table}")
+
+    with conn.cursor() as cur:
+        save_gold_watermarks(cur, windows)
+    conn.commit()
+
+
+def rewind_gold(conn, backfill_from):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE gold.watermarks
+            SET high_water_ts = LEAST(high_water_ts, %s), updated_at = now()
+            """,
+            (backfill_from,),
+        )
+        cur.execute(
+            """
+            UPDATE gold.rollup_watermarks
+            SET high_water_ts = LEAST(high_water_ts, %s), updated_at = now()
+            """,
+            (backfill_from,),
+        )
     conn.commit()
 
 
-def run_gold_transforms(conn):
-    truncate_gold(conn)
-    build_daily_user_activity(conn)
-    build_daily_song_plays(conn)
-    build_user_sessions(conn)
-    build_subscription_funnel_daily(conn)
-    build_daily_geo_activity(conn)
-    build_user_lifetime_metrics(conn)
-
-
-def get_pg_conn():
-    host = os.getenv("POSTGRES_HOST", "localhost")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    dbname = os.getenv("POSTGRES_DB", "soundflow")
-    user = os.getenv("POSTGRES_USER", "postgres")
-    password = os.getenv("POSTGRES_PASSWORD", "postgres")
-
-    attempt = 0
-    while True:
-        try:
-            return psycopg2.connect(
-                host=host,
-                port=port,
-                dbname=dbname,
-                user=user,
-                password=password,
-                connect_timeout=5,
+def shadow_name(name):
+    return f"{name[:50]}__shadow"
+
+
+def wal_lsn(cur):
+    cur.execute("SELECT pg_current_wal_lsn()")
+    return cur.fetchone()[0]
+
+
+def wal_since(cur, lsn):
+    cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (lsn,))
+    return int(cur.fetchone()[0])
+
+
+def table_indexes(cur, table):
+    cur.execute(
+        """
+        SELECT i.relname, pg_get_indexdef(i.oid), c.conname,
+               pg_get_constraintdef(c.oid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint c
+          ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+        WHERE x.indrelid = %s::regclass
+        ORDER BY x.indisprimary DESC, i.relname
+        """,
+        (table,),
+    )
+    return cur.fetchall()
+
+
+def create_shadow_indexes(cur, table, shadow, constraints):
+    # the shadow's indexes get temporary names, the live table still owns
+    # the real ones until the swap
+    for index, definition, constraint, constraint_def in table_indexes(cur, table):
+        if (constraint is not None) != constraints:
+            continue
+        if constraint is not None:
+            cur.execute(
+                f"ALTER TABLE {shadow} ADD CONSTRAINT {shadow_name(constraint)} "
+                f"{constraint_def}"
             )
+        else:
+            unique, _, _, body = INDEX_DEF.match(definition).groups()
+            cur.execute(
+                f"CREATE {unique or ''}INDEX {shadow_name(index)} ON {shadow} {body}"
+            )
+
 
-        except psycopg2.OperationalError as exc:
-            attempt += 1
-            if attempt >= 5:
+def table_dependents(cur, table):
+    # views and foreign keys point at the table's oid, which the swap drops
+    cur.execute(
+        """
+        SELECT DISTINCT r.ev_class::regclass::text
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.classid = 'pg_rewrite'::regclass
+          AND d.refobjid = %(table)s::regclass
+          AND r.ev_class <> %(table)s::regclass
+        UNION
+        SELECT conrelid::regclass::text
+        FROM pg_constraint
+        WHERE confrelid = %(table)s::regclass
+        ORDER BY 1
+        """,
+        {"table": table},
+    )
+    return [name for name, in cur.fetchall()]
+
+
+def copy_table_metadata(cur, table, shadow):
+    # grants and comments belong to the table being dropped, the shadow
+    # takes them over before the rename
+    cur.execute(
+        """
+        SELECT a.privilege_type,
+               CASE WHEN a.grantee = 0 THEN 'PUBLIC'
+                    ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+               a.is_grantable
+        FROM pg_class c, aclexplode(c.relacl) a
+        WHERE c.oid = %s::regclass
+          AND a.grantee <> c.relowner
+        """,
+        (table,),
+    )
+    for privilege, grantee, grantable in cur.fetchall():
+        option = " WITH GRANT OPTION" if grantable else ""
+        cur.execute(f"GRANT {privilege} ON {shadow} TO {grantee}{option}")
+
+    cur.execute(
+        """
+        SELECT NULL, obj_description(%(table)s::regclass, 'pg_class')
+        UNION ALL
+        SELECT quote_ident(attname), col_description(attrelid, attnum)
+        FROM pg_attribute
+        WHERE attrelid = %(table)s::regclass
+          AND attnum > 0
+          AND NOT attisdropped
+        """,
+        {"table": table},
+    )
+    for column, comment in cur.fetchall():
+        if comment is None:
+            continue
+        target = f"TABLE {shadow}" if column is None else f"COLUMN {shadow}.{column}"
+        cur.execute(f"COMMENT ON {target} IS %s", (comment,))
+
+
+@instrumented("gold", name_arg="table")
+def rebuild_by_swap(conn, table, build):
+    # the model is built into unlogged shadows nobody reads, indexed and
+    # analyzed there, and swapped in by renames in one short transaction, so
+    # readers see either the old table or the complete new one
+    tables = [table] + [name for name, _ in BY_PRODUCTS.get(table, ())]
+    with conn.cursor() as cur:
+        for name in tables:
+            dependents = table_dependents(cur, name)
+            if dependents:
                 raise RuntimeError(
-                    f"Failed to connect to PostgreSQL after {attempt} attempts"
-                ) from exc
+                    f"{name} cannot be swapped, {', '.join(dependents)} "
+                    "depend on it; rebuild it without --swap"
+                )
+        for name in tables:
+            shadow = shadow_name(name)
+            cur.execute(f"DROP TABLE IF EXISTS {shadow}")
+            cur.execute(
+                f"CREATE UNLOGGED TABLE {shadow} (LIKE {name} INCLUDING DEFAULTS)"
+            )
+            if table in UPSERT_MODELS:
+                create_shadow_indexes(cur, name, shadow, constraints=True)
+    conn.commit()
+
+    rows = build(conn, shadows={name: shadow_name(name) for name in tables})
+    conn.commit()
+
+    with conn.cursor() as cur:
+        for name in tables:
+            shadow = shadow_name(name)
+            if table not in UPSERT_MODELS:
+                create_shadow_indexes(cur, name, shadow, constraints=True)
+            create_shadow_indexes(cur, name, shadow, constraints=False)
+            # SET LOGGED rewrites the table and its indexes and writes all of
+            # it to the WAL (unless wal_level is minimal): the build is not
+            # logged row by row, but the finished table is logged in full
+            cur.execute(f"ALTER TABLE {shadow} SET LOGGED")
+            cur.execute(f"ANALYZE {shadow}")
+    conn.commit()
+
+    with conn.cursor() as cur:
+        for name in tables:
+            schema, relname = name.split(".")
+            indexes = [index for index, *_ in table_indexes(cur, name)]
+            copy_table_metadata(cur, name, shadow_name(name))
+            cur.execute(f"DROP TABLE {name}")
+            cur.execute(f"ALTER TABLE {shadow_name(name)} RENAME TO {relname}")
+            for index in indexes:
+                cur.execute(
+                    f"ALTER INDEX {schema}.{shadow_name(index)} RENAME TO {index}"
+                )
+    conn.commit()
+    return rows
 
-            sleep_time = 2 * (2 ** (attempt - 1))
-            time.sleep(sleep_time)
+
+def run_gold_transforms(conn, single_scan=False, swap=False):
+    with conn.cursor() as cur:
+        windows = gold_windows(cur)
+        wal_start = wal_lsn(cur)
+    if not swap:
+        truncate_gold(conn)
+    if single_scan:
+        stage_gold_events(conn)
+        conn.commit()
+
+    for table, build in model_builders(single_scan).items():
+        if swap:
+            rebuild_by_swap(conn, table, build)
+        else:
+            build(conn)
+        conn.commit()
+
+    with conn.cursor() as cur:
+        if swap:
+            # what truncate_gold resets, minus the swapped models themselves
+            cur.execute("DELETE FROM gold.watermarks")
+            cur.execute("DELETE FROM gold.rollup_watermarks")
+            if not STREAM_SESSIONS:
+                cur.execute("DELETE FROM gold.session_watermarks")
+        save_gold_watermarks(cur, windows)
+        print(f"gold rebuild wrote {wal_since(cur, wal_start) / 2**20:.1f} MiB of WAL")
+    conn.commit()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build gold models from silver")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="truncate gold and rebuild every model from all of silver (default)",
+    )
+    mode.add_argument(
+        "--incremental",
+        action="store_true",
+        help="rebuild only the dates, sessions and users with new silver rows",
+    )
+    mode.add_argument(
+        "--backfill-from",
+        metavar="TS",
+        help="rebuild everything touched by silver rows ingested after TS",
+    )
+    parser.add_argument(
+        "--single-scan",
+        action="store_true",
+        help="read silver once into staging.gold_events and build every model from it",
+    )
+    parser.add_argument(
+        "--sketches",
+        action="store_true",
+        help="store HyperLogLog sketches next to the distinct counts, which "
+        "then become estimates (about 1.6%% standard error)",
+    )
+    parser.add_argument(
+        "--swap",
+        action="store_true",
+        help="full refresh: build every model into an unlogged shadow table "
+        "and swap it in, instead of truncating the live tables",
+    )
+    parser.add_argument(
+        "--funnel-engine",
+        choices=FUNNEL_ENGINES,
+        default=FUNNEL_ENGINE,
+        help="ordered: one sorted aggregate pass that also fills "
+        "gold.subscription_transitions; window: the first/last_value build",
+    )
+    parser.add_argument(
+        "--stream-sessions",
+        action="store_true",
+        help="build gold.user_sessions with gold/sessionize.py instead of SQL",
+    )
+    parser.add_argument(
+        "--report-io",
+        action="store_true",
+        help="print the bytes each model scanned",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    args = parser.parse_args()
+    if args.swap and (args.incremental or args.backfill_from):
+        parser.error(
+            "--swap is a full refresh, it cannot be combined with "
+            "--incremental or --backfill-from"
+        )
+    if args.swap and args.stream_sessions:
+        # the sessionizer merges into gold.user_sessions in place
+        parser.error("--stream-sessions cannot rebuild gold.user_sessions by --swap")
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
     conn = get_pg_conn()
     try:
-        run_gold_transforms(conn)
+        with etl_run(get_pg_conn, "gold", args.metrics_jsonl, vars(args)):
+            if args.report_io:
+                enable_io_report(conn)
+            if args.sketches:
+                enable_sketches()
+            if args.stream_sessions:
+                enable_stream_sessions()
+            set_funnel_engine(args.funnel_engine)
+            if args.backfill_from:
+                rewind_gold(conn, args.backfill_from)
+                run_gold_incremental(conn, args.single_scan)
+            elif args.incremental:
+                run_gold_incremental(conn, args.single_scan)
+            else:
+                run_gold_transforms(conn, args.single_scan, args.swap)
+            if args.stream_sessions:
+                # merged session parts cannot be rewound, so a backfill
+                # sessionizes all of silver again
+                sessionize = load_module("gold_sessionize", "gold/sessionize.py")
+                sessionize.run_sessionize(conn, full=not args.incremental)
+            if args.report_io:
+                print_io_report()
     finally:
         conn.close()
@@ -0,0 +1,175 @@
+import argparse
+import os
+import re
+import sys
+import time
+import zlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
+
+LOAD_TABLES = {
+    "bronze": (
+        "bronze.auth_events",
+        "bronze.listen_events",
+        "bronze.page_view_events",
+        "bronze.status_change_events",
+    ),
+    "silver": (
+        "silver.auth_events",
+        "silver.listen_events",
+        "silver.page_view_events",
+        "silver.status_change_events",
+    ),
+}
+
+INDEX_DEF = re.compile(r"^CREATE INDEX (\S+) ON (ONLY )?(\S+) (.*)$")
+
+
+def secondary_indexes(cur, table):
+    # unique indexes stay: the silver inserts resolve ON CONFLICT with them
+    cur.execute(
+        """
+        SELECT n.nspname || '.' || i.relname, pg_get_indexdef(i.oid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_namespace n ON n.oid = i.relnamespace
+        WHERE x.indrelid = %s::regclass
+          AND NOT x.indisunique
+          AND NOT x.indisprimary
+        ORDER BY 1
+        """,
+        (table,),
+    )
+    return cur.fetchall()
+
+
+@instrumented("indexes")
+def defer_indexes(conn, layers=tuple(LOAD_TABLES)):
+    dropped = 0
+    with conn.cursor() as cur:
+        for layer in layers:
+            for table in LOAD_TABLES[layer]:
+                for name, definition in secondary_indexes(cur, table):
+                    cur.execute(
+                        """
+                        INSERT INTO etl_deferred_indexes (
+                            index_name, table_name, definition
+                        )
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (index_name) DO NOTHING
+                        """,
+                        (name, table, definition),
+                    )
+                    # dropping a partitioned index drops every partition's too
+                    cur.execute(f"DROP INDEX {name}")
+                    dropped += 1
+    conn.commit()
+    print(f"dropped {dropped} secondary indexes before the load")
+    return dropped
+
+
+def partitions(cur, table):
+    cur.execute(
+        """
+        SELECT n.nspname || '.' || c.relname, c.relname
+        FROM pg_inherits h
+        JOIN pg_class c ON c.oid = h.inhrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE h.inhparent = %s::regclass
+        ORDER BY 1
+        """,
+        (table,),
+    )
+    return cur.fetchall()
+
+
+def rebuild_index(cur, name, table, definition):
+    # an index is always created in its table's schema, so only the
+    # relation name goes into CREATE INDEX
+    schema, index = name.split(".")
+    _, only, _, body = INDEX_DEF.match(definition).groups()
+    if not only:
+        cur.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} {body}"
+        )
+        return
+
+    # CONCURRENTLY is not supported on a partitioned table: the parent index
+    # is created empty and invalid, every partition gets its own index built
+    # concurrently, and the parent becomes valid once all are attached
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {index} ON ONLY {table} {body}")
+    suffix = f"{zlib.crc32(index.encode()):08x}"
+    for partition, relname in partitions(cur, table):
+        child = f"{relname[:50]}_{suffix}"
+        cur.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} {body}"
+        )
+        cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {schema}.{child}")
+
+
+@instrumented("indexes")
+def rebuild_indexes(conn):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    autocommit = conn.autocommit
+    conn.commit()
+    conn.autocommit = True
+    rebuilt = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT index_name, table_name, definition
+                FROM etl_deferred_indexes
+                ORDER BY dropped_at, index_name
+                """)
+            for name, table, definition in cur.fetchall():
+                started = time.perf_counter()
+                rebuild_index(cur, name, table, definition)
+                cur.execute(
+                    "DELETE FROM etl_deferred_indexes WHERE index_name = %s", (name,)
+                )
+                print(f"rebuilt {name} in {time.perf_counter() - started:.2f}s")
+                rebuilt += 1
+    finally:
+        conn.autocommit = autocommit
+    return rebuilt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Drop bronze/silver secondary indexes for a bulk load "
+        "and rebuild them concurrently afterwards"
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--defer",
+        nargs="+",
+        choices=sorted(LOAD_TABLES),
+        metavar="LAYER",
+        help="drop the secondary indexes of these layers",
+    )
+    mode.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="rebuild every index dropped by --defer",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        with etl_run(get_pg_conn, "indexes", args.metrics_jsonl, vars(args)):
+            if args.defer:
+                defer_indexes(conn, args.defer)
+            else:
+                rebuild_indexes(conn)
+    finally:
+        conn.close()
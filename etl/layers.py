@@ -0,0 +1,12 @@
+import importlib.util
+import os
+
+ETL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_module(name, relpath):
+    # the layers are standalone scripts, two of them named transform.py
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ETL_DIR, relpath))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
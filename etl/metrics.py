@@ -0,0 +1,222 @@
+import functools
+import inspect
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+STAT_COLUMNS = (
+    "shared_blks_hit",
+    "shared_blks_read",
+    "shared_blks_dirtied",
+    "shared_blks_written",
+    "temp_blks_read",
+    "temp_blks_written",
+    "blk_read_time",
+    "blk_write_time",
+    "wal_bytes",
+)
+
+# both sources cover the whole database: a stage's deltas include whatever
+# ran concurrently with it, e.g. the other stages of a pipeline run
+PG_STAT_STATEMENTS_SQL = """
+SELECT
+    sum(shared_blks_hit),
+    sum(shared_blks_read),
+    sum(shared_blks_dirtied),
+    sum(shared_blks_written),
+    sum(temp_blks_read),
+    sum(temp_blks_written),
+    sum(blk_read_time),
+    sum(blk_write_time),
+    sum(wal_bytes)
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+"""
+
+# without pg_stat_statements: database-wide counters, which the stats
+# collector publishes with up to ~500ms delay
+PG_STAT_DATABASE_SQL = """
+SELECT
+    blks_hit,
+    blks_read,
+    NULL,
+    NULL,
+    NULL,
+    temp_bytes / current_setting('block_size')::bigint,
+    blk_read_time,
+    blk_write_time,
+    NULL
+FROM pg_stat_database
+WHERE datname = current_database()
+"""
+
+# the run of the current process, set by etl_run()
+ACTIVE_RUN = None
+
+
+def stats_source(cur):
+    cur.execute(
+        "SELECT count(*) FROM pg_extension WHERE extname = 'pg_stat_statements'"
+    )
+    return "pg_stat_statements" if cur.fetchone()[0] else "pg_stat_database"
+
+
+def run_conn(run):
+    # forked bronze workers must not share the parent's connection
+    if run["pid"] != os.getpid():
+        run["conn"] = run["connect"]()
+        run["conn"].autocommit = True
+        run["pid"] = os.getpid()
+    return run["conn"]
+
+
+def snapshot(run):
+    with run_conn(run).cursor() as cur:
+        if run["source"] == "pg_stat_database":
+            cur.execute("SELECT pg_stat_clear_snapshot()")
+            cur.execute(PG_STAT_DATABASE_SQL)
+        else:
+            cur.execute(PG_STAT_STATEMENTS_SQL)
+        return cur.fetchone()
+
+
+def stat_deltas(before, after):
+    deltas = {}
+    for column, old, new in zip(STAT_COLUMNS, before, after):
+        deltas[column] = None if old is None or new is None else float(new - old)
+    return deltas
+
+
+def record_stage(run, metric):
+    with run_conn(run).cursor() as cur:
+        cur.execute(
+            f"""
+            INSERT INTO etl_stage_metrics (
+                run_id, stage, started_at, wall_seconds, rows_affected,
+                rows_per_sec, stats_source, status, error,
+                {", ".join(STAT_COLUMNS)}
+            )
+            VALUES (
+                %(run_id)s, %(stage)s, %(started_at)s, %(wall_seconds)s,
+                %(rows_affected)s, %(rows_per_sec)s, %(stats_source)s,
+                %(status)s, %(error)s,
+                {", ".join(f"%({column})s" for column in STAT_COLUMNS)}
+            )
+            """,
+            metric,
+        )
+    write_jsonl(run, dict(metric, started_at=metric["started_at"].isoformat()))
+
+
+def write_jsonl(run, record):
+    if run["jsonl"] is None:
+        return
+    with open(run["jsonl"], "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def instrumented(layer, stage=None, name_arg=None):
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = ACTIVE_RUN
+            if run is None:
+                return func(*args, **kwargs)
+
+            stage_name = f"{layer}.{stage or func.__name__}"
+            if name_arg is not None:
+                bound = signature.bind(*args, **kwargs)
+                stage_name += f"[{bound.arguments[name_arg]}]"
+
+            metric = {
+                "run_id": run["run_id"],
+                "stage": stage_name,
+                "started_at": datetime.now(timezone.utc),
+                "stats_source": run["source"],
+                "status": "succeeded",
+                "error": None,
+                "rows_affected": None,
+            }
+            before = snapshot(run)
+            result = None
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                metric["status"] = "failed"
+                metric["error"] = repr(exc)
+                raise
+            finally:
+                wall = time.perf_counter() - started
+                metric["wall_seconds"] = wall
+                if isinstance(result, int):
+                    metric["rows_affected"] = result
+                rows = metric["rows_affected"]
+                metric["rows_per_sec"] = rows / wall if rows and wall > 0 else None
+                # a metrics failure must not replace the stage's own exception
+                try:
+                    metric.update(stat_deltas(before, snapshot(run)))
+                    record_stage(run, metric)
+                except Exception as e:
+                    print(f"could not record metrics of {stage_name}: {e!r}")
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def etl_run(connect, layer, jsonl=None, args=None):
+    global ACTIVE_RUN
+    conn = connect()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        source = stats_source(cur)
+        cur.execute(
+            "INSERT INTO etl_runs (layer, args) VALUES (%s, %s) RETURNING run_id",
+            (layer, json.dumps(args)),
+        )
+        run_id = cur.fetchone()[0]
+
+    ACTIVE_RUN = {
+        "run_id": run_id,
+        "layer": layer,
+        "source": source,
+        "jsonl": jsonl,
+        "conn": conn,
+        "connect": connect,
+        "pid": os.getpid(),
+    }
+    status = "failed"
+    try:
+        yield ACTIVE_RUN
+        status = "succeeded"
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE etl_runs
+                SET finished_at = now(), status = %s
+                WHERE run_id = %s
+                RETURNING started_at, finished_at
+                """,
+                (status, run_id),
+            )
+            started_at, finished_at = cur.fetchone()
+        write_jsonl(
+            ACTIVE_RUN,
+            {
+                "run_id": run_id,
+                "layer": layer,
+                "status": status,
+                "started_at": started_at.isoformat(),
+                "finished_at": finished_at.isoformat(),
+            },
+        )
+        ACTIVE_RUN = None
+        conn.close()
@@ -0,0 +1,342 @@
+import argparse
+import fnmatch
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from db import get_pg_conn, get_pg_pool
+from layers import ETL_DIR, load_module
+from metrics import etl_run
+
+EVENT_TABLES = (
+    "auth_events",
+    "listen_events",
+    "page_view_events",
+    "status_change_events",
+)
+
+ALL_SILVER = tuple(f"silver.{name}" for name in EVENT_TABLES)
+
+GOLD_DEPENDENCIES = {
+    "gold.daily_user_activity": ("silver.listen_events", "silver.page_view_events"),
+    "gold.daily_song_plays": ("silver.listen_events",),
+    "gold.user_sessions": ALL_SILVER,
+    "gold.subscription_funnel_daily": (
+        "silver.auth_events",
+        "silver.status_change_events",
+    ),
+    "gold.daily_geo_activity": ALL_SILVER,
+    "gold.daily_level_state_users": ALL_SILVER,
+    "gold.user_lifetime_metrics": ALL_SILVER,
+}
+
+
+bronze = load_module("bronze_extract", "bronze/extract.py")
+silver = load_module("silver_transform", "silver/transform.py")
+gold = load_module("gold_transform", "gold/transform.py")
+rollup = load_module("gold_rollup", "gold/rollup.py")
+sessionize = load_module("gold_sessionize", "gold/sessionize.py")
+enrich = load_module("enrich", "enrich/enrich.py")
+export = load_module("parquet_export", "export/export.py")
+indexes = load_module("indexes", "indexes/indexes.py")
+
+
+def run_bronze(name, args, conn):
+    if not args.incremental:
+        bronze.truncate_bronze(conn, (name,))
+    return bronze.extract_events(
+        conn,
+        name,
+        args.loader,
+        incremental=args.incremental,
+        parser=args.parser,
+    )
+
+
+def run_silver(name, args, conn):
+    if not args.incremental:
+        silver.truncate_silver_table(conn, f"bronze.{name}", f"silver.{name}")
+    # each silver stage runs after its own bronze stage, so only open writers
+    # of that bronze table (none in a full run) can cap its window
+    return getattr(silver, f"transform_{name}")(conn, full_refresh=not args.incremental)
+
+
+def run_gold_model(table, swap, conn):
+    if swap:
+        return gold.rebuild_by_swap(conn, table, gold.SILVER_BUILDERS[table])
+    gold.truncate_model(conn, table)
+    return gold.SILVER_BUILDERS[table](conn)
+
+
+def save_gold_watermarks(conn):
+    with conn.cursor() as cur:
+        gold.save_gold_watermarks(cur, gold.gold_windows(cur))
+
+
+def build_stages(args):
+    stages = {}
+    for name in EVENT_TABLES:
+        stages[f"bronze.{name}"] = ((), partial(run_bronze, name, args))
+        stages[f"silver.{name}"] = (
+            (f"bronze.{name}",),
+            partial(run_silver, name, args),
+        )
+
+    stages["silver.user_agent_dim"] = (ALL_SILVER, silver.parse_user_agents)
+
+    if args.incremental:
+        # the incremental gold refresh swaps every touched date in one
+        # transaction, so it stays a single stage
+        stages["gold"] = (ALL_SILVER, gold.run_gold_incremental)
+    else:
+        for table, deps in GOLD_DEPENDENCIES.items():
+            stages[table] = (deps, partial(run_gold_model, table, args.swap))
+        stages["gold.watermarks"] = (tuple(GOLD_DEPENDENCIES), save_gold_watermarks)
+
+    if args.stream_sessions:
+        # keeps its own watermarks, so it is a separate stage in both modes
+        stages["gold.user_sessions"] = (
+            GOLD_DEPENDENCIES["gold.user_sessions"],
+            partial(sessionize.run_sessionize, full=not args.incremental),
+        )
+
+    # rollups read the daily models up to the gold watermarks
+    gold_done = ("gold",) if args.incremental else ("gold.watermarks",)
+    stages["gold.rollups"] = (
+        gold_done,
+        partial(rollup.run_rollups, full=not args.incremental),
+    )
+
+    for name in args.enrich or ():
+        stages[f"enrich.{name}"] = (
+            ALL_SILVER,
+            partial(enrich.run_enrichment, name=name, options=vars(args)),
+        )
+
+    if args.defer_indexes:
+        # bronze and silver load without their secondary indexes; everything
+        # that reads silver waits until they are rebuilt
+        loads = {
+            f"{layer}.{name}" for layer in indexes.LOAD_TABLES for name in EVENT_TABLES
+        }
+        for name, (deps, func) in list(stages.items()):
+            if name in loads:
+                stages[name] = (deps + ("indexes.defer",), func)
+            else:
+                stages[name] = (deps + ("indexes.rebuild",), func)
+        stages["indexes.defer"] = ((), indexes.defer_indexes)
+        stages["indexes.rebuild"] = (ALL_SILVER, indexes.rebuild_indexes)
+
+    if args.export_dir:
+        # the export follows the silver and gold watermarks, so it runs last
+        stages["export"] = (
+            ALL_SILVER + gold_done + ("gold.rollups", "gold.user_sessions"),
+            partial(export.run_export, out_dir=args.export_dir),
+        )
+    return stages
+
+
+def downstream(stages, roots):
+    selected = set(roots)
+    changed = True
+    while changed:
+        changed = False
+        for name, (deps, _) in stages.items():
+            if name not in selected and selected.intersection(deps):
+                selected.add(name)
+                changed = True
+    return selected
+
+
+def match_stages(stages, patterns):
+    matched = set()
+    for pattern in patterns:
+        names = [
+            name
+            for name in stages
+            if fnmatch.fnmatch(name, pattern) or name.startswith(f"{pattern}.")
+        ]
+        if not names:
+            raise SystemExit(f"no stage matches {pattern!r}, see --list")
+        matched.update(names)
+    return matched
+
+
+def select_stages(stages, only=None, start=None):
+    selected = set(stages)
+    if only:
+        selected = match_stages(stages, only)
+    if start:
+        selected &= downstream(stages, match_stages(stages, start))
+
+    # advancing the gold watermarks is only safe once every model has
+    # caught up to silver
+    deps, _ = stages.get("gold.watermarks", ((), None))
+    if "gold.watermarks" in selected and not set(deps) <= selected:
+        selected.discard("gold.watermarks")
+    return [name for name in stages if name in selected]
+
+
+def run_stage(pool, name, func):
+    conn = pool.getconn()
+    try:
+        started = time.perf_counter()
+        rows = func(conn)
+        conn.commit()
+        print(f"{name} finished in {time.perf_counter() - started:.2f}s")
+        return rows
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+def run_dag(pool, stages, selected, workers):
+    # dependencies outside the selection are taken as already done
+    pending = {name: set(stages[name][0]).intersection(selected) for name in selected}
+    done = set()
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if not failed:
+                for name in [n for n, deps in pending.items() if deps <= done]:
+                    del pending[name]
+                    future = executor.submit(run_stage, pool, name, stages[name][1])
+                    running[future] = name
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as exc:
+                    print(f"{name} failed: {exc!r}")
+                    failed.append(name)
+
+    if failed:
+        raise RuntimeError(
+            f"{', '.join(failed)} failed, {len(pending)} stages were not started"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run bronze, silver and gold as one dependency graph"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="keep existing data and only load what is new in every layer",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="stages run concurrently, each on its own pooled connection",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        metavar="STAGE",
+        help="run only these stages, by name, layer or glob (gold.daily_*)",
+    )
+    parser.add_argument(
+        "--from",
+        dest="start",
+        nargs="+",
+        metavar="STAGE",
+        help="run these stages and everything downstream of them",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="print the selected stages and their dependencies, then exit",
+    )
+    parser.add_argument(
+        "--sketches",
+        action="store_true",
+        help="store HyperLogLog sketches in gold, see gold/transform.py --sketches",
+    )
+    parser.add_argument(
+        "--swap",
+        action="store_true",
+        help="rebuild gold models in unlogged shadow tables and swap them in",
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="drop bronze/silver secondary indexes before loading and rebuild "
+        "them concurrently afterwards, see indexes/indexes.py",
+    )
+    parser.add_argument(
+        "--funnel-engine",
+        choices=gold.FUNNEL_ENGINES,
+        default=gold.FUNNEL_ENGINE,
+        help="how gold.subscription_funnel_daily is built, see gold/transform.py",
+    )
+    parser.add_argument(
+        "--stream-sessions",
+        action="store_true",
+        help="build gold.user_sessions in one ordered pass, see gold/sessionize.py",
+    )
+    parser.add_argument(
+        "--enrich",
+        nargs="+",
+        choices=list(enrich.ENRICHMENTS),
+        help="also run these python enrichments once silver is loaded",
+    )
+    parser.add_argument(
+        "--export-dir",
+        metavar="DIR",
+        help="finish with a parquet export of the changed silver and gold partitions",
+    )
+    parser.add_argument("--loader", choices=bronze.LOADERS, default="insert")
+    parser.add_argument("--parser", choices=bronze.PARSERS, default="fast")
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    args = parser.parse_args()
+    if args.swap and args.incremental:
+        parser.error("--swap rebuilds whole models and cannot be --incremental")
+    if args.swap and args.stream_sessions:
+        # the sessionizer merges into gold.user_sessions in place
+        parser.error("--stream-sessions cannot rebuild gold.user_sessions by --swap")
+    return args
+
+
+def main():
+    args = parse_args()
+    stages = build_stages(args)
+    selected = select_stages(stages, args.only, args.start)
+    if args.list:
+        for name in selected:
+            print(f"{name:<36} <- {', '.join(stages[name][0]) or '-'}")
+        return
+
+    # bronze checkpoints are keyed by the data/<table> path the extract
+    # script sees from its own directory
+    os.chdir(os.path.join(ETL_DIR, "bronze"))
+    if args.sketches:
+        gold.enable_sketches()
+    if args.stream_sessions:
+        gold.enable_stream_sessions()
+    gold.set_funnel_engine(args.funnel_engine)
+    pool = get_pg_pool(args.workers)
+    try:
+        with etl_run(get_pg_conn, "pipeline", args.metrics_jsonl, vars(args)):
+            run_dag(pool, stages, selected, args.workers)
+    finally:
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+
+PARTITIONED_TABLES = {
+    "bronze": (
+        "bronze.auth_events",
+        "bronze.listen_events",
+        "bronze.page_view_events",
+        "bronze.status_change_events",
+    ),
+    "silver": (
+        "silver.auth_events",
+        "silver.listen_events",
+        "silver.page_view_events",
+        "silver.status_change_events",
+    ),
+}
+
+
+def drop_old_partitions(conn, layers, keep_days):
+    dropped = []
+    with conn.cursor() as cur:
+        for layer in layers:
+            for table in PARTITIONED_TABLES[layer]:
+                cur.execute(
+                    "SELECT drop_partitions_older_than(%s::regclass, %s)",
+                    (table, keep_days),
+                )
+                dropped.extend(row[0] for row in cur.fetchall())
+    conn.commit()
+
+    for partition in dropped:
+        print(f"dropped {partition}")
+    print(f"dropped {len(dropped)} partitions older than {keep_days} days")
+    return dropped
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Drop bronze/silver partitions that fall outside retention"
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        required=True,
+        help="drop monthly partitions that end more than this many days ago",
+    )
+    parser.add_argument(
+        "--layers",
+        nargs="+",
+        choices=sorted(PARTITIONED_TABLES),
+        default=sorted(PARTITIONED_TABLES),
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = get_pg_conn()
+    try:
+        drop_old_partitions(conn, args.layers, args.days)
+    finally:
+        conn.close()
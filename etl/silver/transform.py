@@ -1,6 +1,17 @@
-import psycopg2
+import argparse
+import csv
+import gzip
+import io
 import os
-import time
+import re
+import sys
+from functools import lru_cache
+
+import psycopg2.extras
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_pg_conn  # noqa: E402
+from metrics import etl_run, instrumented  # noqa: E402
 
 
 def truncate_silver(conn):
@@ -9,7 +20,9 @@ def truncate_silver(conn):
         silver.auth_events,
         silver.listen_events,
         silver.page_view_events ,
-        silver.status_change_events 
+        silver.status_change_events,
+        silver.watermarks,
+        silver.enrichment_watermarks
     RESTART IDENTITY;
     """
     with conn.cursor() as cur:
@@ -17,225 +30,639 @@ def truncate_silver(conn):
     conn.commit()
 
 
-def transform_auth_events(conn):
-    sql = """
-    INSERT INTO silver.auth_events (
-        event_ts,
-        user_id,
-        session_id,
-        success,
-        level,
-        city,
-        state,
-        zip,
-        user_agent,
-        lat,
-        lon,
-        item_in_session,
-        ingestion_ts
-    )
-    SELECT
-        event_ts,
-        user_id,
-        session_id,
-        success,
-        level,
-        city,
-        state,
-        payload->>'zip',
-        payload->>'userAgent',
-        (payload->>'lat')::double precision,
-        (payload->>'lon')::double precision,
-        (payload->>'itemInSession')::integer,
-        ingestion_ts
-    FROM bronze.auth_events;
-    """
-
+def truncate_silver_table(conn, source, target):
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(f"TRUNCATE TABLE {target}")
+        cur.execute("DELETE FROM silver.watermarks WHERE source_table = %s", (source,))
+        cur.execute(
+            "DELETE FROM silver.enrichment_watermarks WHERE source_table = %s",
+            (target,),
+        )
+    conn.commit()
+
 
+def rewind_silver(conn, backfill_from):
+    tables = {
+        "bronze.auth_events": "silver.auth_events",
+        "bronze.listen_events": "silver.listen_events",
+        "bronze.page_view_events": "silver.page_view_events",
+        "bronze.status_change_events": "silver.status_change_events",
+    }
+    with conn.cursor() as cur:
+        for source, target in tables.items():
+            cur.execute(
+                f"DELETE FROM {target} WHERE ingestion_ts > %s", (backfill_from,)
+            )
+            cur.execute(
+                """
+                INSERT INTO silver.watermarks (source_table, high_water_ts)
+                VALUES (%s, %s)
+                ON CONFLICT (source_table) DO UPDATE SET
+                    high_water_ts = LEAST(
+                        silver.watermarks.high_water_ts, EXCLUDED.high_water_ts
+                    ),
+                    updated_at = now()
+                """,
+                (source, backfill_from),
+            )
+            cur.execute(
+                """
+                UPDATE silver.enrichment_watermarks
+                SET high_water_ts = LEAST(high_water_ts, %s), updated_at = now()
+                WHERE source_table = %s
+                """,
+                (backfill_from, target),
+            )
     conn.commit()
 
 
-def transform_listen_events(conn):
-    sql = """
-    INSERT INTO silver.listen_events (
-        event_ts,
-        user_id,
-        session_id,
-        artist,
-        song,
-        duration,
-        level,
-        auth,
-        city,
-        state,
-        zip,
-        user_agent,
-        lat,
-        lon,
-        item_in_session,
-        ingestion_ts
-    )
-    SELECT
-        event_ts,
-        user_id,
-        session_id,
-        artist,
-        song,
-        (payload->>'duration')::double precision,
-        level,
-        auth,
-        city,
-        state,
-        payload->>'zip',
-        payload->>'userAgent',
-        (payload->>'lat')::double precision,
-        (payload->>'lon')::double precision,
-        (payload->>'itemInSession')::integer,
-        ingestion_ts
-    FROM bronze.listen_events;
-    """
+def transform_window(cur, source, full_refresh=False):
+    cur.execute(
+        "SELECT high_water_ts FROM silver.watermarks WHERE source_table = %s",
+        (source,),
+    )
+    row = cur.fetchone()
+    low = row[0] if row else "-infinity"
+
+    cur.execute(f"SELECT max(ingestion_ts) FROM {source}")
+    newest = cur.fetchone()[0]
+    if full_refresh:
+        # the next full refresh truncates again, so nothing is left behind
+        return low, newest
+
+    # stop short of rows written by transactions that are still open, their
+    # ingestion_ts is already in the past and they would be skipped forever.
+    # Only sessions holding a write lock on the source itself count
+    cur.execute(
+        """
+        SELECT min(a.xact_start) - interval '1 microsecond'
+        FROM pg_stat_activity a
+        WHERE a.backend_type = 'client backend'
+          AND a.datname = current_database()
+          AND a.pid <> pg_backend_pid()
+          AND a.xact_start IS NOT NULL
+          AND EXISTS (
+              SELECT 1
+              FROM pg_locks l
+              WHERE l.pid = a.pid
+                AND l.relation = %s::regclass
+                AND l.mode = 'RowExclusiveLock'
+          )
+        """,
+        (source,),
+    )
+    open_since = cur.fetchone()[0]
+    if newest is None or open_since is None or open_since >= newest:
+        return low, newest
+    print(
+        f"stopping {source} at {open_since}, an open transaction is still "
+        f"writing to it; newer rows wait for the next run"
+    )
+    return low, open_since
+
+
+SONG_SOURCES = ("bronze.listen_events", "bronze.page_view_events")
+SONGS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "events",
+    "data",
+    "songs_analysis.txt.gz",
+)
+
+
+AGENTS_CTE = """
+agents AS (
+    INSERT INTO silver.user_agent_dim (ua_hash, user_agent)
+    SELECT DISTINCT hashtextextended(agent, 0) AS ua_hash, agent
+    FROM window_rows
+    WHERE agent IS NOT NULL
+    ORDER BY ua_hash
+    ON CONFLICT (ua_hash) DO NOTHING
+    RETURNING 1
+)
+"""
+
+SONGS_CTE = """
+songs AS (
+    INSERT INTO silver.songs (artist, song, duration)
+    SELECT DISTINCT ON (artist, song) artist, song, duration
+    FROM window_rows
+    WHERE artist IS NOT NULL
+      AND song IS NOT NULL
+    ORDER BY artist, song, duration IS NULL
+    ON CONFLICT (artist, song) DO UPDATE SET
+        duration = EXCLUDED.duration
+    WHERE silver.songs.duration IS NULL
+    RETURNING 1
+)
+"""
+
+
+def register_dimensions(cur, source, low, high):
+    # the insert below looks user_agent_id and song_id up, so every agent and
+    # song in the window needs a dimension row first. One pass over the window
+    # feeds both; agents go in ua_hash order and songs in (artist, song)
+    # order, so concurrent silver stages lock them in the same order
+    columns = ["payload->>'userAgent' AS agent"]
+    ctes = [AGENTS_CTE]
+    counts = ["(SELECT count(*) FROM agents)"]
+    if source in SONG_SOURCES:
+        columns += [
+            "artist",
+            "song",
+            "(payload->>'duration')::double precision AS duration",
+        ]
+        ctes.append(SONGS_CTE)
+        counts.append("(SELECT count(*) FROM songs)")
+    cur.execute(
+        f"""
+        WITH window_rows AS (
+            SELECT {", ".join(columns)}
+            FROM {source}
+            WHERE ingestion_ts > %(low)s
+              AND ingestion_ts <= %(high)s
+        ),
+        {",".join(ctes)}
+        SELECT {", ".join(counts)}
+        """,
+        {"low": low, "high": high},
+    )
+    return cur.fetchone()
+
+
+def seed_songs(conn, path):
+    # songs_analysis.txt.gz from eventsim: track id, artist, title and
+    # duration, tab separated, latin-1
+    buf = io.StringIO()
+    with gzip.open(path, "rt", encoding="latin-1", newline="") as f:
+        writer = csv.writer(buf)
+        for fields in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if len(fields) < 4 or not fields[1] or not fields[2]:
+                continue
+            try:
+                duration = float(fields[3])
+            except ValueError:
+                duration = None
+            writer.writerow((fields[1], fields[2], duration))
+    buf.seek(0)
 
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute("""
+            CREATE TEMP TABLE song_seed (
+                artist text, song text, duration double precision
+            ) ON COMMIT DROP
+            """)
+        cur.copy_expert("COPY song_seed FROM STDIN WITH (FORMAT csv)", buf)
+        cur.execute("""
+            INSERT INTO silver.songs (artist, song, duration)
+            SELECT DISTINCT ON (artist, song) artist, song, duration
+            FROM song_seed
+            ORDER BY artist, song, duration NULLS LAST
+            ON CONFLICT (artist, song) DO NOTHING
+            """)
+        seeded = cur.rowcount
+    conn.commit()
+    print(f"seeded {seeded} songs from {path}")
+    return seeded
+
+
+def event_fp(event_type):
+    # 64-bit fingerprint of the natural event key; the same line loaded twice
+    # hashes the same and is dropped by the unique (event_fp, event_ts) index
+    return f"""hashtextextended(
+            concat_ws(
+                '|',
+                '{event_type}',
+                coalesce(user_id, -1),
+                coalesce(session_id, -1),
+                coalesce(payload->>'itemInSession', ''),
+                (extract(epoch FROM event_ts) * 1000000)::bigint
+            ),
+            0
+        )"""
 
+
+def record_dedup(cur, source, low, high, candidates, inserted):
+    duplicates = candidates - inserted
+    cur.execute(
+        """
+        INSERT INTO silver.dedup_stats (
+            source_table, low_water_ts, high_water_ts, candidates, inserted, duplicates
+        )
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """,
+        (source, low, high, candidates, inserted, duplicates),
+    )
+    return duplicates
+
+
+def run_incremental(conn, source, target, sql, full_refresh=False):
+    with conn.cursor() as cur:
+        # silver is partitioned like bronze, so mirroring bronze's partitions
+        # covers every event_ts the insert can produce
+        cur.execute("SELECT ensure_partitions_like(%s, %s)", (target, source))
     conn.commit()
 
+    with conn.cursor() as cur:
+        low, high = transform_window(cur, source, full_refresh)
+    conn.commit()
+    if high is None:
+        return 0
 
-def transform_page_view_events(conn):
-    sql = """
-    INSERT INTO silver.page_view_events (
-        event_ts,
-        user_id,
-        session_id,
-        page,
-        method,
-        status,
-        auth,
-        level,
-        artist,
-        song,
-        duration,
-        city,
-        state,
-        zip,
-        user_agent,
-        lat,
-        lon,
-        item_in_session,
-        ingestion_ts
-    )
-    SELECT
-        event_ts,
-        user_id,
-        session_id,
-        page,
-        method,
-        status,
-        auth,
-        level,
-        artist,
-        song,
-        (payload->>'duration')::double precision,
-        city,
-        state,
-        payload->>'zip',
-        payload->>'userAgent',
-        (payload->>'lat')::double precision,
-        (payload->>'lon')::double precision,
-        (payload->>'itemInSession')::integer,
-        ingestion_ts
-    FROM bronze.page_view_events;
-    """
+    # the dimensions are shared by the silver tables; they are committed in a
+    # short transaction of its own, so concurrent silver stages never wait
+    # on each other's uncommitted dimension rows for a whole fact insert
+    with conn.cursor() as cur:
+        register_dimensions(cur, source, low, high)
+    conn.commit()
 
+    # the transforms read the window once: their candidates feed the insert
+    # and are counted next to the rows it kept, the rest were duplicates
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(sql, {"low": low, "high": high})
+        candidates, insert_cnt = cur.fetchone()
+        duplicates = record_dedup(cur, source, low, high, candidates, insert_cnt)
+        cur.execute(
+            """
+            INSERT INTO silver.watermarks (source_table, high_water_ts)
+            VALUES (%s, %s)
+            ON CONFLICT (source_table) DO UPDATE SET
+                high_water_ts = GREATEST(
+                    silver.watermarks.high_water_ts, EXCLUDED.high_water_ts
+                ),
+                updated_at = now()
+            """,
+            (source, high),
+        )
 
     conn.commit()
+    rate = duplicates / candidates if candidates else 0.0
+    print(
+        f"inserted {insert_cnt} in {target}, "
+        f"dropped {duplicates} duplicates ({rate:.2%})"
+    )
+    return insert_cnt
 
 
-def transform_status_change_events(conn):
-    sql = """
-    INSERT INTO silver.status_change_events (
-        event_ts,
-        user_id,
-        session_id,
-        auth,
-        level,
-        city,
-        state,
-        zip,
-        user_agent,
-        lat,
-        lon,
-        item_in_session,
-        ingestion_ts
-    )
-    SELECT
-        event_ts,
-        user_id,
-        session_id,
-        auth,
-        level,
-        city,
-        state,
-        payload->>'zip',
-        payload->>'userAgent',
-        (payload->>'lat')::double precision,
-        (payload->>'lon')::double precision,
-        (payload->>'itemInSession')::integer,
-        ingestion_ts
-    FROM bronze.status_change_events;
+@instrumented("silver")
+def transform_auth_events(conn, full_refresh=False):
+    sql = f"""
+    WITH candidates AS (
+        SELECT
+            event_ts,
+            user_id,
+            session_id,
+            success,
+            level,
+            city,
+            state,
+            payload->>'zip',
+            ua.ua_id,
+            (payload->>'lat')::double precision,
+            (payload->>'lon')::double precision,
+            (payload->>'itemInSession')::integer,
+            {event_fp("auth")},
+            ingestion_ts
+        FROM bronze.auth_events
+        LEFT JOIN silver.user_agent_dim ua
+            ON ua.ua_hash = hashtextextended(payload->>'userAgent', 0)
+        WHERE ingestion_ts > %(low)s
+          AND ingestion_ts <= %(high)s
+    ),
+    inserted AS (
+        INSERT INTO silver.auth_events (
+            event_ts,
+            user_id,
+            session_id,
+            success,
+            level,
+            city,
+            state,
+            zip,
+            user_agent_id,
+            lat,
+            lon,
+            item_in_session,
+            event_fp,
+            ingestion_ts
+        )
+        SELECT * FROM candidates
+        ON CONFLICT (event_fp, event_ts) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM inserted);
     """
 
-    with conn.cursor() as cur:
-        cur.execute(sql)
+    return run_incremental(
+        conn, "bronze.auth_events", "silver.auth_events", sql, full_refresh
+    )
+
+
+@instrumented("silver")
+def transform_listen_events(conn, full_refresh=False):
+    sql = f"""
+    WITH candidates AS (
+        SELECT
+            event_ts,
+            user_id,
+            session_id,
+            songs.song_id,
+            level,
+            auth,
+            city,
+            state,
+            payload->>'zip',
+            ua.ua_id,
+            (payload->>'lat')::double precision,
+            (payload->>'lon')::double precision,
+            (payload->>'itemInSession')::integer,
+            {event_fp("listen")},
+            ingestion_ts
+        FROM bronze.listen_events
+        LEFT JOIN silver.songs
+            ON songs.artist = bronze.listen_events.artist
+           AND songs.song = bronze.listen_events.song
+        LEFT JOIN silver.user_agent_dim ua
+            ON ua.ua_hash = hashtextextended(payload->>'userAgent', 0)
+        WHERE ingestion_ts > %(low)s
+          AND ingestion_ts <= %(high)s
+    ),
+    inserted AS (
+        INSERT INTO silver.listen_events (
+            event_ts,
+            user_id,
+            session_id,
+            song_id,
+            level,
+            auth,
+            city,
+            state,
+            zip,
+            user_agent_id,
+            lat,
+            lon,
+            item_in_session,
+            event_fp,
+            ingestion_ts
+        )
+        SELECT * FROM candidates
+        ON CONFLICT (event_fp, event_ts) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM inserted);
+    """
+
+    return run_incremental(
+        conn, "bronze.listen_events", "silver.listen_events", sql, full_refresh
+    )
+
+
+@instrumented("silver")
+def transform_page_view_events(conn, full_refresh=False):
+    sql = f"""
+    WITH candidates AS (
+        SELECT
+            event_ts,
+            user_id,
+            session_id,
+            page,
+            method,
+            status,
+            auth,
+            level,
+            songs.song_id,
+            city,
+            state,
+            payload->>'zip',
+            ua.ua_id,
+            (payload->>'lat')::double precision,
+            (payload->>'lon')::double precision,
+            (payload->>'itemInSession')::integer,
+            {event_fp("page_view")},
+            ingestion_ts
+        FROM bronze.page_view_events
+        LEFT JOIN silver.songs
+            ON songs.artist = bronze.page_view_events.artist
+           AND songs.song = bronze.page_view_events.song
+        LEFT JOIN silver.user_agent_dim ua
+            ON ua.ua_hash = hashtextextended(payload->>'userAgent', 0)
+        WHERE ingestion_ts > %(low)s
+          AND ingestion_ts <= %(high)s
+    ),
+    inserted AS (
+        INSERT INTO silver.page_view_events (
+            event_ts,
+            user_id,
+            session_id,
+            page,
+            method,
+            status,
+            auth,
+            level,
+            song_id,
+            city,
+            state,
+            zip,
+            user_agent_id,
+            lat,
+            lon,
+            item_in_session,
+            event_fp,
+            ingestion_ts
+        )
+        SELECT * FROM candidates
+        ON CONFLICT (event_fp, event_ts) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM inserted);
+    """
+
+    return run_incremental(
+        conn, "bronze.page_view_events", "silver.page_view_events", sql, full_refresh
+    )
+
 
+@instrumented("silver")
+def transform_status_change_events(conn, full_refresh=False):
+    sql = f"""
+    WITH candidates AS (
+        SELECT
+            event_ts,
+            user_id,
+            session_id,
+            auth,
+            level,
+            city,
+            state,
+            payload->>'zip',
+            ua.ua_id,
+            (payload->>'lat')::double precision,
+            (payload->>'lon')::double precision,
+            (payload->>'itemInSession')::integer,
+            {event_fp("status_change")},
+            ingestion_ts
+        FROM bronze.status_change_events
+        LEFT JOIN silver.user_agent_dim ua
+            ON ua.ua_hash = hashtextextended(payload->>'userAgent', 0)
+        WHERE ingestion_ts > %(low)s
+          AND ingestion_ts <= %(high)s
+    ),
+    inserted AS (
+        INSERT INTO silver.status_change_events (
+            event_ts,
+            user_id,
+            session_id,
+            auth,
+            level,
+            city,
+            state,
+            zip,
+            user_agent_id,
+            lat,
+            lon,
+            item_in_session,
+            event_fp,
+            ingestion_ts
+        )
+        SELECT * FROM candidates
+        ON CONFLICT (event_fp, event_ts) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM inserted);
+    """
+
+    return run_incremental(
+        conn,
+        "bronze.status_change_events",
+        "silver.status_change_events",
+        sql,
+        full_refresh,
+    )
+
+
+BROWSER_PATTERNS = (
+    ("Edge", re.compile(r"Edge?/([\d.]+)")),
+    ("Opera", re.compile(r"(?:OPR|Opera)/([\d.]+)")),
+    ("Chrome", re.compile(r"(?:Chrome|CriOS)/([\d.]+)")),
+    ("Firefox", re.compile(r"(?:Firefox|FxiOS)/([\d.]+)")),
+    ("Internet Explorer", re.compile(r"MSIE ([\d.]+)")),
+    ("Internet Explorer", re.compile(r"Trident/.*rv:([\d.]+)")),
+    ("Safari", re.compile(r"Version/([\d.]+).*Safari/")),
+)
+
+OS_PATTERNS = (
+    ("iOS", re.compile(r"(?:iPhone|iPad|iPod).*? OS ([\d_]+)")),
+    ("Android", re.compile(r"Android ([\d.]+)")),
+    ("Windows", re.compile(r"Windows NT ([\d.]+)")),
+    ("Mac OS X", re.compile(r"Mac OS X ([\d_.]+)")),
+    ("Linux", re.compile(r"(?:Linux|X11)()")),
+)
+
+
+def match_first(patterns, agent):
+    for name, pattern in patterns:
+        m = pattern.search(agent)
+        if m:
+            return name, m.group(1).replace("_", ".") or None
+    return "Other", None
+
+
+@lru_cache(maxsize=4096)
+def parse_user_agent(agent):
+    browser, browser_version = match_first(BROWSER_PATTERNS, agent)
+    os_name, os_version = match_first(OS_PATTERNS, agent)
+    if "iPad" in agent or ("Android" in agent and "Mobile" not in agent):
+        device = "tablet"
+    elif any(token in agent for token in ("iPhone", "iPod", "Mobile")):
+        device = "mobile"
+    else:
+        device = "desktop"
+    return browser, browser_version, os_name, os_version, device
+
+
+@instrumented("silver")
+def parse_user_agents(conn):
+    # parsed rows are never read again, so each agent is parsed once ever
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT ua_id, user_agent FROM silver.user_agent_dim WHERE parsed_at IS NULL"
+        )
+        rows = [parse_user_agent(agent) + (ua_id,) for ua_id, agent in cur.fetchall()]
+        psycopg2.extras.execute_batch(
+            cur,
+            """
+            UPDATE silver.user_agent_dim
+            SET browser = %s,
+                browser_version = %s,
+                os = %s,
+                os_version = %s,
+                device = %s,
+                parsed_at = now()
+            WHERE ua_id = %s
+            """,
+            rows,
+        )
     conn.commit()
+    print(f"parsed {len(rows)} new user agents")
+    return len(rows)
 
 
-def run_transforms(conn):
-    truncate_silver(conn)
-    transform_auth_events(conn)
-    transform_listen_events(conn)
-    transform_page_view_events(conn)
-    transform_status_change_events(conn)
-
-
-def get_pg_conn():
-    host = os.getenv("POSTGRES_HOST", "localhost")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    dbname = os.getenv("POSTGRES_DB", "soundflow")
-    user = os.getenv("POSTGRES_USER", "postgres")
-    password = os.getenv("POSTGRES_PASSWORD", "postgres")
-
-    attempt = 0
-    while True:
-        try:
-            return psycopg2.connect(
-                host=host,
-                port=port,
-                dbname=dbname,
-                user=user,
-                password=password,
-                connect_timeout=5,
-            )
+def run_transforms(conn, full_refresh=True, backfill_from=None):
+    if full_refresh:
+        truncate_silver(conn)
+    elif backfill_from is not None:
+        rewind_silver(conn, backfill_from)
+    transform_auth_events(conn, full_refresh)
+    transform_listen_events(conn, full_refresh)
+    transform_page_view_events(conn, full_refresh)
+    transform_status_change_events(conn, full_refresh)
+    parse_user_agents(conn)
 
-        except psycopg2.OperationalError as exc:
-            attempt += 1
-            if attempt >= 5:
-                raise RuntimeError(
-                    f"Failed to connect to PostgreSQL after {attempt} attempts"
-                ) from exc
 
-            sleep_time = 2 * (2 ** (attempt - 1))
-            time.sleep(sleep_time)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Transform bronze into silver")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="truncate silver and rebuild it from all of bronze (default)",
+    )
+    mode.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only transform bronze rows newer than each table's watermark",
+    )
+    mode.add_argument(
+        "--backfill-from",
+        metavar="TS",
+        help="drop silver rows ingested after TS and transform them again",
+    )
+    parser.add_argument(
+        "--seed-songs",
+        nargs="?",
+        const=SONGS_PATH,
+        metavar="PATH",
+        help="first load the eventsim song catalogue into silver.songs",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="also append run and stage metrics to this json lines file",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_args()
     conn = get_pg_conn()
     try:
-        run_transforms(conn)
+        with etl_run(get_pg_conn, "silver", args.metrics_jsonl, vars(args)):
+            if args.seed_songs:
+                seed_songs(conn, args.seed_songs)
+            run_transforms(
+                conn,
+                full_refresh=not (args.incremental or args.backfill_from),
+                backfill_from=args.backfill_from,
+            )
     finally:
         conn.close()
@@ -1,8 +1,10 @@
 #!/bin/bash
 
-cd etl/bronze
-uv run extract.py
-cd ../silver
-uv run transform.py
-cd ../gold
-uv run transform.py
+# ETL_INCREMENTAL=1 keeps existing data and only loads what is new
+MODE_ARGS=""
+if [ "${ETL_INCREMENTAL:-0}" = "1" ]; then
+    MODE_ARGS="--incremental"
+fi
+
+cd etl
+uv run pipeline.py --workers "${ETL_WORKERS:-4}" $MODE_ARGS
@@ -1,3 +1,151 @@
 CREATE SCHEMA IF NOT EXISTS bronze;
 CREATE SCHEMA IF NOT EXISTS silver;
 CREATE SCHEMA IF NOT EXISTS gold;
+CREATE SCHEMA IF NOT EXISTS staging;
+
+-- monthly range partitions on event_ts, created on demand by the loaders.
+-- month boundaries are taken in UTC so every session agrees on them.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(
+    parent regclass,
+    lo timestamptz,
+    hi timestamptz
+) RETURNS integer
+LANGUAGE plpgsql AS $$
+DECLARE
+    parent_schema text;
+    parent_table text;
+    month_start timestamptz;
+    part_name text;
+    created integer := 0;
+BEGIN
+    SELECT n.nspname, c.relname
+    INTO parent_schema, parent_table
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = parent;
+
+    -- concurrent loaders would otherwise race on the same partition
+    PERFORM pg_advisory_xact_lock(hashtext(parent::text));
+
+    month_start := date_trunc('month', lo AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    WHILE month_start <= hi LOOP
+        part_name := parent_table || '_p'
+            || to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM');
+        IF to_regclass(format('%I.%I', parent_schema, part_name)) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I.%I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+                parent_schema,
+                part_name,
+                parent,
+                month_start,
+                month_start + interval '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+
+    RETURN created;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION partition_bounds(parent regclass)
+RETURNS TABLE (partition regclass, lower_bound timestamptz, upper_bound timestamptz)
+LANGUAGE sql STABLE AS $$
+    SELECT
+        c.oid::regclass,
+        substring(pg_get_expr(c.relpartbound, c.oid) FROM 'FROM \(''([^'']*)''\)')
+            ::timestamptz,
+        substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \(''([^'']*)''\)')
+            ::timestamptz
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent;
+$$;
+
+-- give target a partition for every partition source has
+CREATE OR REPLACE FUNCTION ensure_partitions_like(
+    target regclass,
+    source regclass
+) RETURNS integer
+LANGUAGE sql AS $$
+    SELECT COALESCE(
+        sum(ensure_monthly_partitions(target, lower_bound, lower_bound)), 0
+    )::integer
+    FROM partition_bounds(source);
+$$;
+
+CREATE OR REPLACE FUNCTION drop_partitions_older_than(
+    parent regclass,
+    keep_days integer
+) RETURNS SETOF text
+LANGUAGE plpgsql AS $$
+DECLARE
+    part record;
+BEGIN
+    FOR part IN
+        SELECT partition
+        FROM partition_bounds(parent)
+        WHERE upper_bound <= now() - make_interval(days => keep_days)
+        ORDER BY lower_bound
+    LOOP
+        EXECUTE format('DROP TABLE %s', part.partition);
+        RETURN NEXT part.partition::text;
+    END LOOP;
+END;
+$$;
+
+-- HyperLogLog sketches for mergeable distinct counts (gold --sketches).
+-- A sketch is a sorted int[] holding register * 64 + rank for every
+-- non-empty register of 2^12 = 4096; only touched registers are stored, so
+-- small groups stay small. Standard error is 1.04 / sqrt(4096), about 1.6%.
+CREATE OR REPLACE FUNCTION hll_item(v bigint) RETURNS integer
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+    -- the low 12 hash bits pick the register, the rank is the position of
+    -- the first set bit in the other 52
+    SELECT substring(h FROM 53 FOR 12)::bit(12)::integer * 64
+        + COALESCE(NULLIF(position(B'1' IN substring(h FROM 1 FOR 52)), 0), 53)
+    FROM (SELECT hashtextextended(v::text, 0)::bit(64) AS h) t;
+$$;
+
+CREATE OR REPLACE FUNCTION hll_compact(items integer[]) RETURNS integer[]
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    -- keep the highest rank per register; NULL items are no register
+    SELECT array_agg(item ORDER BY item)
+    FROM (
+        SELECT max(item) AS item
+        FROM unnest(items) AS item
+        WHERE item IS NOT NULL
+        GROUP BY item / 64
+    ) t;
+$$;
+
+CREATE OR REPLACE FUNCTION hll_cardinality(sketch integer[])
+RETURNS double precision
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+    SELECT CASE
+        WHEN raw <= 2.5 * 4096 AND empty > 0 THEN 4096 * ln(4096.0 / empty)
+        ELSE raw
+    END
+    FROM (
+        SELECT
+            0.7213 / (1 + 1.079 / 4096) * 4096 * 4096
+                / (4096 - count(item) + COALESCE(sum(power(2.0, -(item % 64))), 0))
+                AS raw,
+            4096 - count(item) AS empty
+        FROM unnest(sketch) AS item
+    ) t;
+$$;
+
+-- compacting in the state function keeps the state at most one register
+-- per slot, however many sketches are merged
+CREATE OR REPLACE FUNCTION hll_union(state integer[], sketch integer[])
+RETURNS integer[]
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT hll_compact(array_cat(state, sketch));
+$$;
+
+CREATE OR REPLACE AGGREGATE hll_union_agg(integer[]) (
+    SFUNC = hll_union,
+    STYPE = integer[]
+);
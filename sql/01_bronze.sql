@@ -8,7 +8,7 @@ CREATE TABLE bronze.auth_events (
     state text,
     payload jsonb NOT NULL,
     ingestion_ts timestamptz DEFAULT now()
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE bronze.listen_events (
     event_ts timestamptz NOT NULL,
@@ -22,7 +22,7 @@ CREATE TABLE bronze.listen_events (
     state text,
     payload jsonb NOT NULL,
     ingestion_ts timestamptz DEFAULT now()
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE bronze.page_view_events (
     event_ts timestamptz NOT NULL,
@@ -39,7 +39,7 @@ CREATE TABLE bronze.page_view_events (
     state text,
     payload jsonb NOT NULL,
     ingestion_ts timestamptz DEFAULT now()
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE bronze.status_change_events (
     event_ts timestamptz NOT NULL,
@@ -51,5 +51,28 @@ CREATE TABLE bronze.status_change_events (
     state text,
     payload jsonb NOT NULL,
     ingestion_ts timestamptz DEFAULT now()
-);
+) PARTITION BY RANGE (event_ts);
+
+-- rows are appended in ingestion order, so a BRIN index narrows every
+-- silver load window to the block ranges written since the last run
+CREATE INDEX ON bronze.auth_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
 
+CREATE INDEX ON bronze.listen_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+CREATE INDEX ON bronze.page_view_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+CREATE INDEX ON bronze.status_change_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+
+CREATE TABLE bronze.ingest_checkpoints (
+    file_path text PRIMARY KEY,
+    file_id text NOT NULL,
+    byte_offset bigint NOT NULL,
+    line_number bigint NOT NULL,
+    last_event_ts timestamptz,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
@@ -7,31 +7,31 @@ CREATE TABLE silver.auth_events (
     city text,
     state text,
     zip text,
-    user_agent text,
+    user_agent_id integer,
     lat double precision,
     lon double precision,
     item_in_session integer,
+    event_fp bigint NOT NULL,
     ingestion_ts timestamptz NOT NULL
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE silver.listen_events (
     event_ts timestamptz NOT NULL,
     user_id integer,
     session_id integer,
-    artist text,
-    song text,
-    duration double precision,
+    song_id integer,
     level text,
     auth text,
     city text,
     state text,
     zip text,
-    user_agent text,
+    user_agent_id integer,
     lat double precision,
     lon double precision,
     item_in_session integer,
+    event_fp bigint NOT NULL,
     ingestion_ts timestamptz NOT NULL
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE silver.page_view_events (
     event_ts timestamptz NOT NULL,
@@ -42,18 +42,17 @@ CREATE TABLE silver.page_view_events (
     status integer,
     auth text,
     level text,
-    artist text,
-    song text,
-    duration double precision,
+    song_id integer,
     city text,
     state text,
     zip text,
-    user_agent text,
+    user_agent_id integer,
     lat double precision,
     lon double precision,
     item_in_session integer,
+    event_fp bigint NOT NULL,
     ingestion_ts timestamptz NOT NULL
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE TABLE silver.status_change_events (
     event_ts timestamptz NOT NULL,
@@ -64,12 +63,13 @@ CREATE TABLE silver.status_change_events (
     city text,
     state text,
     zip text,
-    user_agent text,
+    user_agent_id integer,
     lat double precision,
     lon double precision,
     item_in_session integer,
+    event_fp bigint NOT NULL,
     ingestion_ts timestamptz NOT NULL
-);
+) PARTITION BY RANGE (event_ts);
 
 CREATE INDEX ON silver.listen_events (event_ts, user_id);
 
@@ -78,3 +78,92 @@ CREATE INDEX ON silver.page_view_events (event_ts, user_id);
 CREATE INDEX ON silver.auth_events (event_ts, user_id);
 
 CREATE INDEX ON silver.status_change_events (event_ts, user_id);
+
+-- silver is loaded in ingestion order too; gold windows scan by ingestion_ts
+CREATE INDEX ON silver.listen_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+CREATE INDEX ON silver.page_view_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+CREATE INDEX ON silver.auth_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+CREATE INDEX ON silver.status_change_events USING brin (ingestion_ts)
+    WITH (pages_per_range = 32);
+
+-- one row per event fingerprint; unique indexes on a partitioned table must
+-- include the partition key, and a duplicate has the same event_ts anyway
+CREATE UNIQUE INDEX ON silver.listen_events (event_fp, event_ts);
+
+CREATE UNIQUE INDEX ON silver.page_view_events (event_fp, event_ts);
+
+CREATE UNIQUE INDEX ON silver.auth_events (event_fp, event_ts);
+
+CREATE UNIQUE INDEX ON silver.status_change_events (event_fp, event_ts);
+
+-- per user time order, read by the streaming sessionizer (gold/sessionize.py)
+CREATE INDEX ON silver.listen_events (user_id, event_ts);
+
+CREATE INDEX ON silver.page_view_events (user_id, event_ts);
+
+CREATE INDEX ON silver.auth_events (user_id, event_ts);
+
+CREATE INDEX ON silver.status_change_events (user_id, event_ts);
+
+-- every (artist, song) seen in silver; listen and page view events store song_id
+CREATE TABLE silver.songs (
+    song_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    artist text NOT NULL,
+    song text NOT NULL,
+    duration double precision,
+    UNIQUE (artist, song)
+);
+
+-- one row per distinct user agent string; the event tables store ua_id
+CREATE TABLE silver.user_agent_dim (
+    ua_id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    ua_hash bigint NOT NULL UNIQUE,
+    user_agent text NOT NULL,
+    browser text,
+    browser_version text,
+    os text,
+    os_version text,
+    device text,
+    parsed_at timestamptz
+);
+
+CREATE TABLE silver.watermarks (
+    source_table text PRIMARY KEY,
+    high_water_ts timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- how far each python enrichment stage has read each silver table
+CREATE TABLE silver.enrichment_watermarks (
+    stage text NOT NULL,
+    source_table text NOT NULL,
+    high_water_ts timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (stage, source_table)
+);
+
+-- candidate and duplicate counts of every silver load window
+CREATE TABLE silver.dedup_stats (
+    source_table text NOT NULL,
+    low_water_ts timestamptz,
+    high_water_ts timestamptz NOT NULL,
+    candidates bigint NOT NULL,
+    inserted bigint NOT NULL,
+    duplicates bigint NOT NULL,
+    loaded_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- nearest census ZCTA centroid for every event coordinate seen in silver
+CREATE TABLE silver.geo_zcta (
+    lat double precision NOT NULL,
+    lon double precision NOT NULL,
+    zcta text,
+    distance_km double precision,
+    PRIMARY KEY (lat, lon)
+);
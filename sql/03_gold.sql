@@ -4,18 +4,28 @@ CREATE TABLE gold.daily_user_activity (
     sessions_count integer NOT NULL,
     listens_count integer NOT NULL,
     page_views_count integer NOT NULL,
+    -- hll sketches, only filled by gold --sketches (see hll_item)
+    sessions_sketch integer[],
     PRIMARY KEY (activity_date, user_id)
 );
 
+-- per user history on the dashboard
+CREATE INDEX ON gold.daily_user_activity (user_id, activity_date)
+    INCLUDE (sessions_count, listens_count, page_views_count);
+
 CREATE TABLE gold.daily_song_plays (
     play_date date NOT NULL,
-    artist text NOT NULL,
-    song text NOT NULL,
+    song_id integer NOT NULL,
     plays_count integer NOT NULL,
     unique_users integer NOT NULL,
-    PRIMARY KEY (play_date, artist, song)
+    users_sketch integer[],
+    PRIMARY KEY (play_date, song_id)
 );
 
+-- a song's or an artist's (through silver.songs) plays over a date range
+CREATE INDEX ON gold.daily_song_plays (song_id, play_date)
+    INCLUDE (plays_count, unique_users);
+
 CREATE TABLE gold.user_sessions (
     session_id integer NOT NULL,
     user_id integer NOT NULL,
@@ -26,9 +36,19 @@ CREATE TABLE gold.user_sessions (
     listens_count integer NOT NULL,
     city text,
     state text,
+    entry_page text,
+    exit_page text,
+    is_open boolean NOT NULL DEFAULT false,
     PRIMARY KEY (user_id, session_id)
 );
 
+-- a user's sessions over a date range
+CREATE INDEX ON gold.user_sessions (user_id, session_start_ts)
+    INCLUDE (session_end_ts, session_duration_s, events_count, listens_count);
+
+-- sessions still open when the sessionizer last ran
+CREATE INDEX ON gold.user_sessions (session_end_ts) WHERE is_open;
+
 CREATE TABLE gold.subscription_funnel_daily (
     event_date date NOT NULL,
     user_id integer NOT NULL,
@@ -38,6 +58,20 @@ CREATE TABLE gold.subscription_funnel_daily (
     PRIMARY KEY (event_date, user_id)
 );
 
+-- previous funnel day of a user, looked up for day boundary transitions
+CREATE INDEX ON gold.subscription_funnel_daily (user_id, event_date);
+
+-- level changes between consecutive auth and status change events of a user,
+-- filled by the ordered funnel engine
+CREATE TABLE gold.subscription_transitions (
+    event_date date NOT NULL,
+    user_id integer NOT NULL,
+    from_level text NOT NULL,
+    to_level text NOT NULL,
+    transitions integer NOT NULL,
+    PRIMARY KEY (event_date, user_id, from_level, to_level)
+);
+
 CREATE TABLE gold.daily_geo_activity (
     activity_date date NOT NULL,
     state text NOT NULL,
@@ -45,9 +79,21 @@ CREATE TABLE gold.daily_geo_activity (
     active_users integer NOT NULL,
     total_events integer NOT NULL,
     total_listens integer NOT NULL,
+    users_sketch integer[],
     PRIMARY KEY (activity_date, state, city)
 );
 
+-- one row per user, day, level and state; base of gold.level_state_cube
+CREATE TABLE gold.daily_level_state_users (
+    activity_date date NOT NULL,
+    level text NOT NULL,
+    state text NOT NULL,
+    user_id integer NOT NULL,
+    events_count integer NOT NULL,
+    listens_count integer NOT NULL,
+    PRIMARY KEY (activity_date, level, state, user_id)
+);
+
 CREATE TABLE gold.user_lifetime_metrics (
     user_id integer NOT NULL,
     first_seen_ts timestamptz NOT NULL,
@@ -59,3 +105,82 @@ CREATE TABLE gold.user_lifetime_metrics (
     PRIMARY KEY (user_id)
 );
 
+
+CREATE TABLE gold.watermarks (
+    source_table text PRIMARY KEY,
+    high_water_ts timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- rollups of the daily models (etl/gold/rollup.py); period is 'week' or
+-- 'month' and period_start its first day
+CREATE TABLE gold.user_activity_rollup (
+    period text NOT NULL,
+    period_start date NOT NULL,
+    active_users integer NOT NULL,
+    user_days bigint NOT NULL,
+    sessions_count bigint NOT NULL,
+    listens_count bigint NOT NULL,
+    page_views_count bigint NOT NULL,
+    PRIMARY KEY (period, period_start)
+);
+
+CREATE TABLE gold.geo_activity_rollup (
+    period text NOT NULL,
+    period_start date NOT NULL,
+    state text NOT NULL,
+    city text NOT NULL,
+    user_days bigint NOT NULL,
+    total_events bigint NOT NULL,
+    total_listens bigint NOT NULL,
+    -- merged from the daily sketches, NULL unless gold ran with --sketches
+    active_users integer,
+    PRIMARY KEY (period, period_start, state, city)
+);
+
+CREATE TABLE gold.song_plays_rollup (
+    period text NOT NULL,
+    period_start date NOT NULL,
+    song_id integer NOT NULL,
+    plays_count bigint NOT NULL,
+    listener_days bigint NOT NULL,
+    unique_listeners integer,
+    PRIMARY KEY (period, period_start, song_id)
+);
+
+-- level x state cube; 'all' in level or state is the total over that column
+CREATE TABLE gold.level_state_cube (
+    period text NOT NULL,
+    period_start date NOT NULL,
+    level text NOT NULL,
+    state text NOT NULL,
+    active_users integer NOT NULL,
+    events_count bigint NOT NULL,
+    listens_count bigint NOT NULL,
+    PRIMARY KEY (period, period_start, level, state)
+);
+
+CREATE TABLE gold.rollup_watermarks (
+    source_table text PRIMARY KEY,
+    high_water_ts timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- how far the streaming sessionizer has read each silver table
+CREATE TABLE gold.session_watermarks (
+    source_table text PRIMARY KEY,
+    high_water_ts timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- narrow copy of all silver events, filled once per gold run (--single-scan)
+CREATE UNLOGGED TABLE staging.gold_events (
+    event_type smallint NOT NULL,
+    event_ts timestamptz NOT NULL,
+    user_id integer,
+    session_id integer,
+    level text,
+    song_id integer,
+    city text,
+    state text
+);
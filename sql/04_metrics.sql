@@ -0,0 +1,31 @@
+CREATE TABLE etl_runs (
+    run_id bigserial PRIMARY KEY,
+    layer text NOT NULL,
+    args jsonb,
+    started_at timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz,
+    status text NOT NULL DEFAULT 'running'
+);
+
+CREATE TABLE etl_stage_metrics (
+    run_id bigint NOT NULL REFERENCES etl_runs (run_id),
+    stage text NOT NULL,
+    started_at timestamptz NOT NULL,
+    wall_seconds double precision NOT NULL,
+    rows_affected bigint,
+    rows_per_sec double precision,
+    shared_blks_hit bigint,
+    shared_blks_read bigint,
+    shared_blks_dirtied bigint,
+    shared_blks_written bigint,
+    temp_blks_read bigint,
+    temp_blks_written bigint,
+    blk_read_time double precision,
+    blk_write_time double precision,
+    wal_bytes numeric,
+    stats_source text NOT NULL,
+    status text NOT NULL,
+    error text
+);
+
+CREATE INDEX ON etl_stage_metrics (stage, started_at);
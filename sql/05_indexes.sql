@@ -0,0 +1,8 @@
+-- secondary indexes dropped before a bulk load by etl/indexes/indexes.py,
+-- kept until they are rebuilt so an interrupted load can still restore them
+CREATE TABLE etl_deferred_indexes (
+    index_name text PRIMARY KEY,
+    table_name text NOT NULL,
+    definition text NOT NULL,
+    dropped_at timestamptz NOT NULL DEFAULT now()
+);